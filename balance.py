@@ -0,0 +1,133 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+import roles as R
+import storage as S
+
+CHUNK = 1_000_000
+"""Setups sampled per batch, bounds memory to a few hundred MB"""
+
+
+def default_config() -> S.Config:
+    return {name: role_cls().config.copy() for name, role_cls in R.ROLE_REGISTRY.items()}
+
+
+def sample(config: S.Config, players: int, samples: int, rng: np.random.Generator) -> np.ndarray:
+    """Samples role setups the same way distribution.setup does, all at once
+
+    Args:
+        config: the guild config to roll from
+        players: seats to fill
+        samples: number of setups
+        rng: numpy random generator
+    Returns:
+        ndarray: samples x roles matrix of role counts, columns in config order"""
+    names = list(config)
+    for name in names:
+        if name not in R.ROLE_REGISTRY:
+            raise ValueError(f"Unknown role: {name}")
+    chance = np.array([config[name]["chance"] for name in names])
+    count = np.array([config[name]["count"] for name in names])
+    wolf = names.index("Werewolf")
+    villager = names.index("Villager")
+
+    # Roll every role's chance
+    hit = rng.integers(0, 101, size=(samples, len(names))) <= chance
+    counts = hit * count
+    counts[:, wolf] = np.maximum(counts[:, wolf], 1)
+
+    # Keep one wolf and draw the other seats from the bag of rolled roles,
+    # one role at a time as a chain of hypergeometric draws
+    over = counts.sum(axis=1) > players
+    bag = counts[over]
+    bag[:, wolf] -= 1
+    left = np.full(len(bag), players - 1)
+    remaining = bag.sum(axis=1)
+    for column in range(len(names)):
+        remaining -= bag[:, column]
+        drawn = rng.hypergeometric(bag[:, column], remaining, left)
+        left -= drawn
+        bag[:, column] = drawn
+    bag[:, wolf] += 1
+    counts[over] = bag
+
+    counts[:, villager] += np.maximum(0, players - counts.sum(axis=1))
+    return counts
+
+
+def report(config: S.Config, players: int, samples: int, seed: int | None) -> dict:
+    names = list(config)
+    teams = np.array([R.ROLE_REGISTRY[name]().team for name in names])
+    wolf_columns = teams == "Wolves"
+    rng = np.random.default_rng(seed)
+
+    wolves = np.zeros(players + 1, dtype=np.int64)
+    present = np.zeros(len(names), dtype=np.int64)
+    total = np.zeros(len(names), dtype=np.int64)
+    valid = wolf_majority = 0
+
+    started = time.perf_counter()
+    for offset in range(0, samples, CHUNK):
+        counts = sample(config, players, min(CHUNK, samples - offset), rng)
+        wolf_count = counts[:, wolf_columns].sum(axis=1)
+        village_count = players - wolf_count
+        wolves += np.bincount(wolf_count, minlength=players + 1)
+        present += (counts > 0).sum(axis=0)
+        total += counts.sum(axis=0)
+        # win_check ends the game straight away with one villager or no wolves left
+        valid += int(((village_count > 1) & (wolf_count > 0)).sum())
+        wolf_majority += int((wolf_count >= village_count).sum())
+    elapsed = time.perf_counter() - started
+
+    return {
+        "players": players,
+        "samples": samples,
+        "samples_per_s": samples / elapsed,
+        "wolves": {i: int(n) / samples for i, n in enumerate(wolves) if n},
+        "presence": {name: int(n) / samples for name, n in zip(names, present)},
+        "mean_count": {name: int(n) / samples for name, n in zip(names, total)},
+        "valid": valid / samples,
+        "wolf_majority": wolf_majority / samples,
+    }
+
+
+def show(result: dict) -> None:
+    print(f"{result['players']} players, {result['samples']:,} setups "
+          f"({result['samples_per_s']:,.0f}/s)")
+    print("  wolves: " + ", ".join(f"{n}: {p:.1%}" for n, p in result["wolves"].items()))
+    for name, presence in result["presence"].items():
+        print(f"  {name}: in {presence:.1%} of setups, {result['mean_count'][name]:.2f} on average")
+    print(f"  valid: {result['valid']:.1%}, wolves start with a majority: {result['wolf_majority']:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Samples role setups from a guild config to check its balance"
+    )
+    parser.add_argument("--guild", type=int, help="guild whose config to load from werewolf.db")
+    parser.add_argument("--config", help="json config file to load instead")
+    parser.add_argument("--players", type=int, nargs="+", default=[5, 8, 12, 20])
+    parser.add_argument("--samples", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print the raw results as json")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    elif args.guild is not None:
+        store = S.Store(S.SqliteBackend("werewolf.db"), default_config)
+        config = store.load(args.guild)
+        store.close()
+    config = config or default_config()
+
+    results = [report(config, players, args.samples, args.seed) for players in args.players]
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        for result in results:
+            show(result)
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+import disnake
+
+import main as M
+import simulation as Sim
+import votes as V
+
+GAME_COUNTS = [10, 100, 1000, 10000]
+PLAYER_COUNTS = [5, 10, 25, 50]
+MEMORY_PLAYERS = 20_000
+"""Players hosted at once by the memory benchmark, split into games of each size"""
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def summary(values: list[float], scale=1.0) -> dict[str, float]:
+    if not values:
+        return {}
+    return {
+        "mean": statistics.fmean(values) * scale,
+        "p50": percentile(values, 0.5) * scale,
+        "p99": percentile(values, 0.99) * scale,
+    }
+
+
+async def bench_vote(players: int, rounds: int) -> dict:
+    """Interactions per second through the vote dropdown/confirm path"""
+    transport = Sim.FakeTransport(None)
+    game = Sim.create_game(transport, players)
+    voters = list(game.players.values())
+    session = V.VoteSession(
+        game, "Benchmark", disnake.Colour.yellow(), "vote", voters, voters, True, True
+    )
+    running = asyncio.create_task(session.run())
+    while len(session.embed_ids) < players:
+        await asyncio.sleep(0)
+
+    rng = random.Random(0)
+    options = list(session.targets.values())
+    interactions = [
+        Sim.FakeInteraction(transport, session.custom_id("Select", voter), [rng.choice(options)])
+        for _ in range(rounds)
+        for voter in voters
+    ]
+    interactions += [
+        Sim.FakeInteraction(transport, session.custom_id("Confirm", voter))
+        for voter in voters
+    ]
+
+    started = time.perf_counter()
+    for inter in interactions:
+        await V.vote_router.dispatch(inter)  # pyright: ignore[reportArgumentType]
+    await running
+    elapsed = time.perf_counter() - started
+    M.stop_game(game)
+
+    return {
+        "bench": "vote",
+        "players": players,
+        "interactions": len(interactions),
+        "interactions_per_s": len(interactions) / elapsed,
+        "edits": transport.calls["edit"],
+    }
+
+
+async def bench_games(games: int, players: int, seed: int) -> dict:
+    """Plays concurrent games, each with its own fake transport"""
+    random.seed(seed)
+    rng = random.Random(seed)
+
+    started = time.perf_counter()
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(
+                Sim.play(Sim.FakeTransport(Sim.random_voter(rng)), players, i % 100 + 1)
+            )
+            for i in range(games)
+        ]
+    elapsed = time.perf_counter() - started
+
+    phase_times: dict[str, list[float]] = defaultdict(list)
+    phase_calls: dict[str, list[float]] = defaultdict(list)
+    cycles = []
+    for task in tasks:
+        game = task.result()
+        for phase, times in game.phase_times.items():
+            phase_times[phase].extend(times)
+        for phase, calls in game.phase_calls.items():
+            phase_calls[phase].extend(calls)
+        # A cycle is a night followed by its day
+        cycles.extend(
+            night + day
+            for night, day in zip(game.phase_times["night_phase"], game.phase_times["day_phase"])
+        )
+
+    return {
+        "bench": "games",
+        "games": games,
+        "players": players,
+        "elapsed_s": elapsed,
+        "games_per_s": games / elapsed,
+        "cycle_ms": summary(cycles, 1000),
+        "phase_ms": {phase: summary(times, 1000) for phase, times in phase_times.items()},
+        "calls_per_phase": {
+            phase: statistics.fmean(calls) for phase, calls in phase_calls.items()
+        },
+    }
+
+
+async def bench_memory(games: int, players: int) -> dict:
+    """Bytes held per game with roles assigned and waiting for its first night,
+    and how much of that is the Player and Role objects themselves"""
+    transport = Sim.FakeTransport(None)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    lobbies = [Sim.create_game(transport, players) for _ in range(games)]
+    for game in lobbies:
+        await game.assign_roles()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    objects = sum(
+        sys.getsizeof(player) + sys.getsizeof(player.role)
+        for game in lobbies
+        for player in game.players.values()
+    )
+
+    for game in lobbies:
+        M.stop_game(game)
+    return {
+        "bench": "memory",
+        "games": games,
+        "players": players,
+        "bytes_per_game": used / games,
+        "bytes_per_player": used / (games * players),
+        "object_bytes_per_player": objects / (games * players),
+    }
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def run(game_counts: list[int], player_counts: list[int], seed: int) -> list[dict]:
+    Sim.use_memory_store()
+    results = []
+    for players in player_counts:
+        results.append(await bench_vote(players, rounds=20))
+        results.append(await bench_memory(MEMORY_PLAYERS // players, players))
+        for games in game_counts:
+            result = await bench_games(games, players, seed)
+            print(
+                f"{games} games x {players} players: {result['elapsed_s']:.2f}s, "
+                f"cycle p50 {result['cycle_ms'].get('p50', 0):.1f}ms",
+                file=sys.stderr,
+            )
+            results.append(result)
+    return results
+
+
+def key(result: dict) -> tuple:
+    return result["bench"], result.get("games"), result["players"]
+
+
+def compare(old: list[dict], new: list[dict]) -> None:
+    """Prints how the headline number of each benchmark moved"""
+    headline = {"vote": "interactions_per_s", "games": "games_per_s", "memory": "bytes_per_player"}
+    previous = {key(result): result for result in old}
+    for result in new:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        metric = headline[result["bench"]]
+        change = (result[metric] - before[metric]) / before[metric] * 100
+        print(f"{key(result)} {metric}: {before[metric]:.1f} -> {result[metric]:.1f} ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the game loop against a fake transport")
+    parser.add_argument("--games", type=int, nargs="+", default=GAME_COUNTS)
+    parser.add_argument("--players", type=int, nargs="+", default=PLAYER_COUNTS)
+    parser.add_argument("--quick", action="store_true", help="only 10 and 100 games of 5 and 10 players")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+    if args.quick:
+        args.games, args.players = [10, 100], [5, 10]
+
+    results = asyncio.run(run(args.games, args.players, args.seed))
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "commit": commit(),
+                "python": platform.python_version(),
+                "seed": args.seed,
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f)["results"], results)
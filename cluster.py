@@ -0,0 +1,354 @@
+import argparse
+import asyncio
+import hmac
+import itertools
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import time
+import traceback
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable
+
+ENV = "WEREWOLF_CLUSTER"
+"""Environment variable a worker finds its place in the cluster in"""
+
+HOST = "127.0.0.1"
+PORT_BASE = 7500
+"""Worker n listens for votes passed on by the others on PORT_BASE + n"""
+
+CONNECT_RETRIES = 50
+"""Attempts at reaching another worker, 0.1s apart, before giving up on a message"""
+
+DOWN_DELAY = 5.0
+"""Seconds messages to a worker that couldn't be reached are dropped without trying"""
+
+RESTART_DELAY = 5.0
+"""Seconds before a worker that exited is started again"""
+
+Payload = dict[str, Any]
+Reply = Callable[[Payload, str | None, bool], Awaitable[None]]
+
+
+def shard_for(guild_id: int, shard_count: int) -> int:
+    """The shard Discord sends a guild's events to"""
+    return (guild_id >> 22) % shard_count
+
+
+def split_shards(shard_count: int, workers: int) -> list[list[int]]:
+    return [list(range(worker, shard_count, workers)) for worker in range(workers)]
+
+
+class Cluster:
+    """This process's place in a cluster of workers, each running the shards
+    in shard_ids, and its links to the other workers.
+
+    A guild's games live on the worker that owns its shard, since every
+    command and button in the guild arrives there. DM interactions all arrive
+    on shard 0 though, so a vote click for a game that isn't open on the
+    worker that got it is deferred and passed on to the worker owning its
+    guild."""
+
+    def __init__(
+        self,
+        worker: int,
+        shard_ids: list[int],
+        shard_count: int,
+        ports: list[int],
+        secret: str,
+        host=HOST,
+    ) -> None:
+        """secret: shared by the workers of a cluster, frames without it are dropped"""
+        self.worker = worker
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.ports = ports
+        self.secret = secret
+        self.host = host
+        self.links: dict[int, asyncio.StreamWriter] = {}
+        self.locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.down_until: dict[int, float] = {}
+        """Worker: loop time to try reaching it again at"""
+        self.forwarded = 0
+
+    @classmethod
+    def from_env(cls) -> "Cluster | None":
+        """The cluster the supervisor started this process in, None when run on its own"""
+        data = os.environ.get(ENV)
+        if not data:
+            return None
+        return cls(**json.loads(data))
+
+    def env(self) -> dict[str, str]:
+        data = {
+            "worker": self.worker,
+            "shard_ids": self.shard_ids,
+            "shard_count": self.shard_count,
+            "ports": self.ports,
+            "secret": self.secret,
+            "host": self.host,
+        }
+        return {**os.environ, ENV: json.dumps(data)}
+
+    def port(self, port: int) -> int:
+        """This worker's port of a range starting at port, one per worker"""
+        return port + self.worker
+
+    def path(self, path: str) -> str:
+        """This worker's own file of one the workers would otherwise share"""
+        root, ext = os.path.splitext(path)
+        return f"{root}.{self.worker}{ext}"
+
+    def share(self, limit: int) -> int:
+        """This worker's part of a limit the workers have to stay under together"""
+        return max(1, limit // len(self.ports))
+
+    def owns(self, guild_id: int) -> bool:
+        return shard_for(guild_id, self.shard_count) in self.shard_ids
+
+    def owner(self, guild_id: int) -> int:
+        """The worker running a guild's shard, as laid out by split_shards"""
+        return shard_for(guild_id, self.shard_count) % len(self.ports)
+
+    async def listen(self, handle: Callable[[Payload], Awaitable[None]]) -> asyncio.Server:
+        """Calls handle with every message sent here, in order per sender"""
+
+        async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                while line := await reader.readline():
+                    try:
+                        payload = json.loads(line)
+                        # Any local process can connect, only workers know the secret
+                        if not hmac.compare_digest(str(payload.pop("secret", "")), self.secret):
+                            print("Dropping a message without the cluster secret", file=sys.stderr)
+                            break
+                        await handle(payload)
+                    except Exception:
+                        traceback.print_exc()
+            except (ConnectionError, asyncio.CancelledError):
+                # The other worker went away or this one is shutting down
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(serve, self.host, self.ports[self.worker])
+
+    async def send(self, worker: int, payload: Payload) -> None:
+        # One connection per worker keeps a select ahead of its confirm
+        loop = asyncio.get_running_loop()
+        async with self.locks[worker]:
+            if self.down_until.get(worker, 0) > loop.time():
+                return
+            writer = self.links.get(worker)
+            for _ in range(CONNECT_RETRIES):
+                if writer is not None and not writer.is_closing():
+                    break
+                try:
+                    _, writer = await asyncio.open_connection(self.host, self.ports[worker])
+                except OSError:
+                    await asyncio.sleep(0.1)
+            if writer is None or writer.is_closing():
+                print(f"Worker {worker} is unreachable, dropping messages to it", file=sys.stderr)
+                self.down_until[worker] = loop.time() + DOWN_DELAY
+                return
+            self.links[worker] = writer
+            try:
+                writer.write(json.dumps({**payload, "secret": self.secret}).encode() + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                del self.links[worker]
+
+    async def broadcast(self, payload: Payload) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for worker in range(len(self.ports)):
+                if worker != self.worker:
+                    tg.create_task(self.send(worker, payload))
+
+    def close(self) -> None:
+        for writer in self.links.values():
+            writer.close()
+        self.links = {}
+
+    async def forward(self, inter, guild_id: int | None) -> None:
+        """Passes a vote interaction this worker has no vote open for on to the
+        worker owning its guild, or to all others if the guild isn't known"""
+        self.forwarded += 1
+        payload = {
+            "custom_id": inter.data.custom_id,
+            "values": inter.data.values,
+            "author_id": inter.author.id,
+            "application_id": inter.application_id,
+            "token": inter.token,
+        }
+        if guild_id is None:
+            await self.broadcast(payload)
+        else:
+            await self.send(self.owner(guild_id), payload)
+
+
+class ForwardedInteraction:
+    """Stands in for a vote interaction another worker received and deferred,
+    replies are sent as follow ups through its token"""
+
+    def __init__(self, payload: Payload, reply: Reply) -> None:
+        self.payload = payload
+        self.reply = reply
+        self.author = SimpleNamespace(id=payload["author_id"])
+        self.data = SimpleNamespace(custom_id=payload["custom_id"], values=payload["values"])
+        self.response = SimpleNamespace(defer=self.defer)
+
+    async def defer(self, **kwargs) -> None:
+        pass
+
+    async def send(self, content: str | None = None, ephemeral=False, **fields) -> None:
+        await self.reply(self.payload, content, ephemeral)
+
+
+def supervise(args: list[str], workers: int, shard_count: int, restart=True) -> int:
+    """Starts one process per worker running args and waits on them
+
+    Args:
+        args: the command each worker runs, it finds its shards in the environment
+        workers: number of processes
+        shard_count: total shards, split between the workers
+        restart: start workers that exit again instead of waiting for all to finish
+    Returns:
+        int: the highest exit code of the workers"""
+    ports = [PORT_BASE + worker for worker in range(workers)]
+    secret = secrets.token_hex(16)
+    clusters = [
+        Cluster(worker, shard_ids, shard_count, ports, secret)
+        for worker, shard_ids in enumerate(split_shards(shard_count, workers))
+    ]
+    processes = {c.worker: subprocess.Popen(args, env=c.env()) for c in clusters}
+    exit_code = 0
+    try:
+        while processes:
+            time.sleep(0.5)
+            for worker, process in list(processes.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                exit_code = max(exit_code, code)
+                if not restart:
+                    del processes[worker]
+                    continue
+                print(f"Worker {worker} exited with {code}, restarting", file=sys.stderr)
+                time.sleep(RESTART_DELAY)
+                processes[worker] = subprocess.Popen(args, env=clusters[worker].env())
+    except KeyboardInterrupt:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+    return exit_code
+
+
+# Simulated cluster, checks games stay on their worker and DM votes find them
+
+
+async def simulate_worker(games: int, players: int, seed: int, db: str) -> None:
+    import main as M
+    import simulation as Sim
+    import storage as S
+    import votes as V
+
+    cluster = M.cluster
+    assert cluster is not None
+    M.store = S.Store(S.SqliteBackend(db), M.default_config)
+    M.event_log = None
+    # Message and user ids are unique across workers, like snowflakes
+    Sim.start_message_ids = itertools.count(cluster.worker * 10**9 + 1)
+    followups: Counter[bool] = Counter()
+    done = asyncio.Event()
+    finished = {cluster.worker}
+
+    class GatewayTransport(Sim.FakeTransport):
+        """Clicks on DM votes go to worker 0, the way Discord sends them to shard 0"""
+
+        async def click(self, inter: Sim.FakeInteraction, dm: bool) -> None:
+            if dm and cluster.worker != 0:
+                await cluster.send(0, {"gateway": True, **vars(inter.data), "author_id": inter.author.id})
+            else:
+                await M.route_vote(inter)  # pyright: ignore[reportArgumentType]
+
+    fake = GatewayTransport(Sim.random_voter(random.Random(seed + cluster.worker)))
+
+    async def reply(payload: Payload, content: str | None, ephemeral: bool) -> None:
+        followups[ephemeral] += 1
+
+    async def handle(payload: Payload) -> None:
+        if "done" in payload:
+            finished.add(payload["done"])
+            if len(finished) == len(cluster.ports):
+                done.set()
+        elif payload.get("gateway"):
+            inter = Sim.FakeInteraction(
+                fake, payload["custom_id"], payload["values"], payload["author_id"]
+            )
+            await M.route_vote(inter)  # pyright: ignore[reportArgumentType]
+        else:
+            await V.vote_router.dispatch(ForwardedInteraction(payload, reply))  # pyright: ignore[reportArgumentType]
+
+    server = await cluster.listen(handle)
+    # Guild ids as snowflakes, so they spread over the shards like real ones
+    guilds = [(i % 100 + 1) << 22 for i in range(games)]
+    started = time.perf_counter()
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(Sim.play(fake, players, guild_id, seed + i))
+            for i, guild_id in enumerate(guilds)
+            if cluster.owns(guild_id)
+        ]
+    elapsed = time.perf_counter() - started
+    M.store.close()
+
+    # Worker 0 receives everyone's DM clicks, and passes them on to all of
+    # the others, so every worker stays up until all of them are done
+    await cluster.broadcast({"done": cluster.worker})
+    if len(cluster.ports) > 1:
+        await done.wait()
+    cluster.close()
+    server.close()
+
+    results = [task.result() for task in tasks]
+    print(
+        f"Worker {cluster.worker} (shards {cluster.shard_ids}): {len(results)} games in "
+        f"{elapsed:.2f}s, wins {dict(Counter(game.winning_team for game in results))}, "
+        f"passed on {cluster.forwarded} DM clicks, answered {followups.total()} passed to it",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the bot as several sharded worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shards", type=int, help="total shards, defaults to one per worker")
+    parser.add_argument(
+        "--simulate", action="store_true", help="play bot games instead of connecting to Discord"
+    )
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", default="simulation.db", help="database the simulated workers share")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(simulate_worker(args.games, args.players, args.seed, args.db))
+    elif args.simulate:
+        command = [
+            sys.executable, __file__, "--worker",
+            "--games", str(args.games),
+            "--players", str(args.players),
+            "--seed", str(args.seed),
+            "--db", args.db,
+        ]
+        sys.exit(supervise(command, args.workers, args.shards or args.workers, restart=False))
+    else:
+        main = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        sys.exit(supervise([sys.executable, main], args.workers, args.shards or args.workers))
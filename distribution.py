@@ -0,0 +1,64 @@
+import random
+from collections import Counter
+
+import roles as R
+
+RoleCounts = Counter[str]
+"""Role name: how many of it are in the setup"""
+
+Config = dict[str, dict[str, int]]
+
+
+def roll_counts(config: Config, rng: random.Random) -> RoleCounts:
+    """Rolls each role's chance and adds its count to the setup if it hits
+
+    Args:
+        config: the guild config to roll from
+        rng: the source of randomness, seed it for a reproducible setup
+    Returns:
+        Counter: role name to count, roles that missed are left out"""
+    counts: RoleCounts = Counter()
+    for name, options in config.items():
+        if name not in R.ROLE_REGISTRY:
+            raise ValueError(f"Unknown role: {name}")
+        if options["count"] and rng.randint(0, 100) <= options["chance"]:
+            counts[name] += options["count"]
+    return counts
+
+
+def trim_counts(counts: RoleCounts, players: int, rng: random.Random) -> RoleCounts:
+    """Trims a setup down to one role per player, always keeping a Werewolf.
+
+    The rest are picked uniformly from the rolled roles, the same as drawing
+    them one by one from a bag."""
+    if players <= 0:
+        return Counter()
+    counts = counts.copy()
+    if not counts["Werewolf"]:
+        counts["Werewolf"] = 1
+    if counts.total() <= players:
+        return +counts
+
+    counts["Werewolf"] -= 1
+    chosen: RoleCounts = Counter({"Werewolf": 1})
+    chosen.update(rng.sample(list(counts), players - 1, counts=list(counts.values())))
+    return chosen
+
+
+def fill_counts(counts: RoleCounts, players: int) -> RoleCounts:
+    """Fills the seats no role was rolled for with Villagers"""
+    counts = counts.copy()
+    counts["Villager"] += max(0, players - counts.total())
+    return +counts
+
+
+def setup(config: Config, players: int, rng: random.Random) -> RoleCounts:
+    """Rolls, trims and fills the role counts for a game"""
+    return fill_counts(trim_counts(roll_counts(config, rng), players, rng), players)
+
+
+def deal(counts: RoleCounts, rng: random.Random) -> list[str]:
+    """Shuffles a setup into one role name per seat"""
+    seats = list(counts.elements())
+    rng.shuffle(seats)
+    return seats
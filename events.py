@@ -0,0 +1,128 @@
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from typing import Any, Iterator
+
+import metrics
+from storage import FLUSH_DELAY
+
+MAX_EVENTS = 100_000
+"""Most recent events kept when there is no file to write them to, or while
+writing to it keeps failing"""
+
+MAX_RETRY_DELAY = 60.0
+"""Longest wait between attempts at writing after a failed write"""
+
+Event = dict[str, Any]
+"""{"game": start message id, "t": wall clock time, "event": kind, ...fields}"""
+
+
+class EventLog:
+    """Appends every game's events to one JSON lines file.
+
+    Recording only appends to a list, events are serialised and written off
+    the event loop in one batch per flush_delay, like the Store's writes.
+
+    Events, each with the game's start message id:
+        start: seed, guild, config and players [id, name] in seat order
+        roles: [player id, role] as dealt
+        phase: a night or day beginning
+        select, confirm: vote, voter and target of a dropdown pick or confirm
+        vote: a vote closing, its result, whether it timed out and the
+            confirmed [voter, target] pairs
+        protect, kill, inspect: a night action resolving, its voters and target
+        death: player and the reason they were given
+        resume: the game was picked up after a restart
+        end: the winning team, empty if the game was ended for nobody voting"""
+
+    def __init__(
+        self, path: str | None, flush_delay=FLUSH_DELAY, max_events: int | None = MAX_EVENTS
+    ) -> None:
+        """path: file to append to, None to keep the last max_events in memory only,
+        max_events: None keeps them all, for offline tools"""
+        self.path = path
+        self.flush_delay = flush_delay
+        self.max_events = max_events
+        self.buffer: list[Event] = []
+        self.dropped = 0
+        """Events thrown away because writing them kept failing"""
+        self.events: deque[Event] = deque(maxlen=max_events)
+        """What was recorded, when there is no file to write to"""
+        self.flusher: asyncio.Task | None = None
+
+    def record(self, game_id: int, event: str, **fields) -> None:
+        entry = {"game": game_id, "t": time.time(), "event": event, **fields}
+        if self.path is None:
+            self.events.append(entry)
+            return
+        self.buffer.append(entry)
+        self.trim()
+        self.schedule_flush()
+
+    def schedule_flush(self) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+
+    def take_pending(self) -> list[Event]:
+        events, self.buffer = self.buffer, []
+        return events
+
+    def write(self, events: list[Event]) -> None:
+        assert self.path is not None
+        lines = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+    async def flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        delay = self.flush_delay
+        while self.buffer:
+            events = self.take_pending()
+            try:
+                await asyncio.to_thread(self.write, events)
+            except OSError as e:
+                # e.g. the disk is full, keep the events in order for the next try
+                print(f"Failed to write the event log, retrying: {e}", file=sys.stderr)
+                self.buffer = events + self.buffer
+                self.trim()
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                await asyncio.sleep(delay)
+
+    def trim(self) -> None:
+        """Drops the oldest unwritten events past max_events"""
+        if self.max_events is None or len(self.buffer) <= self.max_events:
+            return
+        dropped = len(self.buffer) - self.max_events
+        del self.buffer[:dropped]
+        self.dropped += dropped
+        metrics.registry.count("events_dropped", dropped)
+        print(f"Dropped the {dropped} oldest unwritten events", file=sys.stderr)
+
+    def flush_sync(self) -> None:
+        if self.buffer:
+            self.write(self.take_pending())
+
+    def close(self) -> None:
+        self.flush_sync()
+
+
+def read(path: str) -> Iterator[Event]:
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def by_game(events: Iterator[Event]) -> dict[int, list[Event]]:
+    """Splits an event log into each game's events, in the order they happened"""
+    games: dict[int, list[Event]] = {}
+    for event in events:
+        games.setdefault(event["game"], []).append(event)
+    return games
@@ -0,0 +1,403 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Sequence
+
+import disnake
+
+import events as E
+import loopwatch
+import main as M
+import metrics
+import simulation as Sim
+import transport as T
+from benchmark import summary
+
+Handler = Callable[[disnake.MessageInteraction], Awaitable[None]]
+
+
+class StormInteraction(Sim.FakeInteraction):
+    """A click from one of many synthetic users on a lobby or vote message.
+    Its responses only wait out the fake latency, they don't go through the
+    rate limit scheduler as Discord doesn't count them against the bot's limits"""
+
+    def __init__(
+        self,
+        transport: Sim.FakeTransport,
+        custom_id: str,
+        values: list[str] | None,
+        user_id: int,
+        message_id: int,
+    ) -> None:
+        super().__init__(transport, custom_id, values, user_id)
+        # Discord's longest display names, the worst case for the lobby message
+        self.author = self.user = SimpleNamespace(
+            id=user_id, name=f"user{user_id}", global_name=f"User {user_id} ".ljust(32, "-")
+        )
+        self.message = SimpleNamespace(id=message_id)
+        self.replies: list[str | None] = []
+
+    async def defer(self, **kwargs) -> None:
+        await super().defer(**kwargs)
+        await asyncio.sleep(self.transport.latency)
+
+    async def send(self, content: str | None = None, **fields) -> None:
+        await super().send(content, **fields)
+        await asyncio.sleep(self.transport.latency)
+        self.replies.append(content)
+
+
+class LagMonitor:
+    """Samples how late the event loop wakes up and how many outbound calls
+    are waiting in the rate limit scheduler"""
+
+    def __init__(self, transport: T.ScheduledTransport, interval=0.01) -> None:
+        self.transport = transport
+        self.interval = interval
+        self.lags: list[float] = []
+        self.queued: list[int] = []
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - expected)
+            self.queued.append(self.transport.scheduler.queued())
+
+
+class Storm:
+    """Fires interactions into the bot's handlers at a set rate, with at most
+    concurrency of them in flight, and times each handler call and the event
+    loop while it fires
+
+    Args:
+        transport: the scheduled transport the game sends through
+        rate: interactions started per second, 0 for as fast as possible
+        concurrency: handler calls in flight at once
+        duplicates: share of interactions Discord delivers a second time
+        rng: picks which ones are redelivered"""
+
+    def __init__(
+        self,
+        transport: T.ScheduledTransport,
+        rate: float,
+        concurrency: int,
+        duplicates: float,
+        rng: random.Random,
+    ) -> None:
+        self.monitor = LagMonitor(transport)
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duplicates = duplicates
+        self.rng = rng
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.redelivered = 0
+        self.in_flight = 0
+        self.dispatching = False
+        self.elapsed = 0.0
+
+    async def call(
+        self, handler: Handler, inter: StormInteraction, slots: asyncio.Semaphore
+    ) -> None:
+        try:
+            started = time.perf_counter()
+            await handler(inter)  # pyright: ignore[reportArgumentType]
+            self.latencies.append(time.perf_counter() - started)
+        finally:
+            self.in_flight -= 1
+            slots.release()
+
+    async def fire(self, clicks: Sequence[tuple[Handler, StormInteraction]]) -> None:
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        started = loop.time()
+        self.dispatching = True
+        sampler = asyncio.create_task(self.monitor.run())
+        try:
+            await self.dispatch(clicks, slots, started)
+        finally:
+            sampler.cancel()
+            self.elapsed += loop.time() - started
+
+    async def dispatch(
+        self,
+        clicks: Sequence[tuple[Handler, StormInteraction]],
+        slots: asyncio.Semaphore,
+        started: float,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        async with asyncio.TaskGroup() as tg:
+            for i, (handler, inter) in enumerate(clicks):
+                if self.rate:
+                    await asyncio.sleep(max(0.0, started + i / self.rate - loop.time()))
+                deliveries = 1
+                if self.rng.random() < self.duplicates:
+                    deliveries = 2
+                    self.redelivered += 1
+                for _ in range(deliveries):
+                    await slots.acquire()
+                    tg.create_task(self.call(handler, inter, slots))
+                    self.sent += 1
+                    self.in_flight += 1
+            self.dispatching = False
+
+
+async def drain(transport: T.ScheduledTransport) -> None:
+    """Waits for the outbound calls a storm left queued to go out"""
+    while transport.scheduler.queued():
+        await asyncio.sleep(0.01)
+
+
+def measure(name: str, storm: Storm, result: dict) -> dict:
+    """Adds the numbers every scenario reports to its own"""
+    lags = storm.monitor.lags
+    return {
+        "scenario": name,
+        "interactions": storm.sent,
+        "redelivered": storm.redelivered,
+        "elapsed_s": storm.elapsed,
+        "interactions_per_s": storm.sent / storm.elapsed,
+        "handler_ms": summary(storm.latencies, 1000),
+        "loop_lag_ms": {**summary(lags, 1000), "max": max(lags, default=0) * 1000},
+        "queued_max": max(storm.monitor.queued, default=0),
+        "superseded_edits": storm.monitor.transport.scheduler.superseded,
+        **result,
+    }
+
+
+async def join_storm(
+    fake: Sim.FakeTransport,
+    transport: T.ScheduledTransport,
+    storm: Storm,
+    users: int,
+    double_clicks: float,
+) -> dict:
+    """Everyone clicks Join on one lobby, some twice, then several click Start at once.
+    Past MAX_PLAYERS users are told the game is full"""
+    game = Sim.create_game(transport, 0)
+    clicks = []
+    for user_id in range(1, users + 1):
+        times = 2 if storm.rng.random() < double_clicks else 1
+        for _ in range(times):
+            inter = StormInteraction(fake, "join", None, user_id, game.start_message_id)
+            clicks.append((M.handle_button_click, inter))
+    await storm.fire(clicks)
+
+    joined: Counter[int] = Counter()
+    full: set[int] = set()
+    for _, inter in clicks:
+        joined[inter.author.id] += inter.replies.count("Joined")
+        if "Game is full" in inter.replies:
+            full.add(inter.author.id)
+    # Let the coalesced lobby edit go out before counting edits
+    while game.lobby_updates.running():
+        await asyncio.sleep(0.01)
+    await drain(transport)
+
+    # The start that wins runs the game until it ends, it is stopped once
+    # the others have all been turned away
+    starts = [
+        (
+            M.handle_button_click,
+            StormInteraction(fake, "start", None, user_id, game.start_message_id),
+        )
+        for user_id in range(1, min(users, 10) + 1)
+    ]
+    firing = asyncio.create_task(storm.fire(starts))
+    await asyncio.sleep(0)
+    while storm.dispatching or storm.in_flight > 1 or game.task is None:
+        await asyncio.sleep(0.01)
+    M.evict(game)
+    await firing
+    started = sum(
+        not any(reply == "Game has already started" for reply in inter.replies)
+        for _, inter in starts
+    )
+    return {
+        "players": len(game.players),
+        "dropped": sum(
+            1
+            for user_id in range(1, users + 1)
+            if user_id not in game.players and user_id not in full
+        ),
+        "duplicated": sum(1 for count in joined.values() if count > 1),
+        "full": len(full - game.players.keys()),
+        "lobby_edits": fake.calls["edit"],
+        "starts_accepted": started,
+    }
+
+
+async def vote_storm(
+    fake: Sim.FakeTransport,
+    transport: T.ScheduledTransport,
+    storm: Storm,
+    players: int,
+    changes: int,
+    double_clicks: float,
+) -> dict:
+    """Everyone changes their pick in a day vote several times, then confirms,
+    some of them twice. A game holds at most MAX_PLAYERS of them"""
+    players = min(players, M.MAX_PLAYERS)
+    game = Sim.create_game(transport, players)
+    await game.assign_roles()
+    game.game_running = True
+    game.phase = "day"
+    voters = list(game.alive.values())
+    M.event_log = E.EventLog(None, max_events=None)
+    vote = asyncio.create_task(
+        game.vote(
+            "Choose a player to exile",
+            disnake.Colour.yellow(),
+            "vote",
+            voters,
+            voters,
+            True,
+            True,
+        )
+    )
+    while not game.sessions or len(next(iter(game.sessions)).embed_ids) < len(voters):
+        await asyncio.sleep(0)
+    session = next(iter(game.sessions))
+    options = list(session.targets.values())
+
+    # Round by round, so each voter's own clicks go out in order
+    clicks = []
+    last: dict[int, int] = {}
+    for _ in range(changes):
+        for voter in voters:
+            choice = storm.rng.choice(options)
+            last[voter.id] = int(choice)
+            custom_id = session.custom_id("Select", voter)
+            clicks.append(
+                (M.handle_dropdown, StormInteraction(fake, custom_id, [choice], voter.id, 0))
+            )
+    for voter in voters:
+        times = 2 if storm.rng.random() < double_clicks else 1
+        for _ in range(times):
+            custom_id = session.custom_id("Confirm", voter)
+            clicks.append(
+                (M.handle_button_click, StormInteraction(fake, custom_id, None, voter.id, 0))
+            )
+    await storm.fire(clicks)
+    # Every click has been handled, so the vote is either closed or never will be
+    closed = session.vote_event.is_set()
+    if closed:
+        await vote
+    else:
+        vote.cancel()
+    await drain(transport)
+
+    confirms = Counter(
+        event["voter"] for event in M.event_log.events if event["event"] == "confirm"
+    )
+    M.event_log = None
+    M.stop_game(game)
+    return {
+        "players": players,
+        "changes": changes,
+        "dropped": sum(1 for voter in voters if voter.id not in session.confirmed),
+        "duplicated": sum(1 for count in confirms.values() if count > 1),
+        "closed": closed,
+        "stale": sum(1 for voter in voters if session.votes[voter.id] != last[voter.id]),
+        "tally_edits": fake.calls["edit"],
+    }
+
+
+async def run(args: argparse.Namespace) -> list[dict]:
+    Sim.use_memory_store()
+    loopwatch.watchdog.start()
+    if args.profile:
+        loopwatch.profiler.start(args.profile)
+    rng = random.Random(args.seed)
+    results = []
+    for scenario in args.scenario:
+        stalls = metrics.registry.total("loop_stalls")
+        fake = Sim.FakeTransport(None, args.latency)
+        transport = T.ScheduledTransport(fake)
+        storm = Storm(transport, args.rate, args.concurrency, args.duplicates, rng)
+        if scenario == "join":
+            result = await join_storm(fake, transport, storm, args.players, args.double_clicks)
+        else:
+            result = await vote_storm(
+                fake, transport, storm, args.players, args.changes, args.double_clicks
+            )
+        result["stalls"] = metrics.registry.total("loop_stalls") - stalls
+        results.append(measure(scenario, storm, result))
+    return results
+
+
+def show(result: dict) -> None:
+    handler, lag = result["handler_ms"], result["loop_lag_ms"]
+    print(
+        f"{result['scenario']}: {result['interactions']} interactions "
+        f"({result['redelivered']} redelivered) in {result['elapsed_s']:.2f}s, "
+        f"{result['interactions_per_s']:,.0f}/s"
+    )
+    print(
+        f"  handler p50 {handler.get('p50', 0):.2f}ms p99 {handler.get('p99', 0):.2f}ms, "
+        f"loop lag p99 {lag.get('p99', 0):.2f}ms max {lag['max']:.2f}ms, "
+        f"up to {result['queued_max']} outbound calls queued, "
+        f"{result['superseded_edits']} edits superseded"
+    )
+    print(
+        f"  {result['stalls']} stalls, dropped {result['dropped']}, "
+        f"duplicated {result['duplicated']}",
+        end="",
+    )
+    if result["scenario"] == "join":
+        print(
+            f", {result['players']} joined, {result['full']} told it was full, "
+            f"{result['lobby_edits']} lobby edits, "
+            f"{result['starts_accepted']} start accepted"
+        )
+    else:
+        print(
+            f", {result['stale']} stale confirms, {result['tally_edits']} tally edits, "
+            f"vote {'closed' if result['closed'] else 'left open'}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fires storms of Join, Start and vote clicks at the handlers"
+    )
+    parser.add_argument(
+        "--scenario", nargs="+", choices=["join", "vote"], default=["join", "vote"]
+    )
+    parser.add_argument("--players", type=int, default=500, help="users clicking")
+    parser.add_argument(
+        "--rate", type=float, default=0, help="interactions per second, 0 for no limit"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=100, help="handler calls in flight at once"
+    )
+    parser.add_argument(
+        "--changes", type=int, default=5, help="dropdown picks per voter before confirming"
+    )
+    parser.add_argument(
+        "--duplicates", type=float, default=0.05, help="share of interactions redelivered"
+    )
+    parser.add_argument(
+        "--double-clicks", type=float, default=0.1, help="share of users clicking twice"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per outbound API call"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", help="write flamegraph samples of the handlers to this file")
+    parser.add_argument("--json", action="store_true", help="print the raw results as json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    loopwatch.profiler.stop()
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        for result in results:
+            show(result)
@@ -0,0 +1,201 @@
+import asyncio
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from types import FrameType
+
+import metrics
+
+TICK_INTERVAL = 0.05
+"""Seconds between two event loop lag measurements"""
+
+STALL_THRESHOLD = 0.1
+"""Seconds of lag past which the loop counts as stalled and what ran is recorded"""
+
+STALLS_KEPT = 20
+
+SAMPLE_INTERVAL = 0.005
+"""Seconds between two profiler samples"""
+
+PROFILE_FLUSH = 10.0
+"""Seconds between two rewrites of the profile file"""
+
+
+def frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def stack(frame: FrameType | None) -> list[FrameType]:
+    """The frames of a stack, outermost first"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def innermost_coroutine(frames: list[FrameType]) -> str:
+    for frame in reversed(frames):
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            return frame_name(frame)
+    return "no coroutine"
+
+
+class Stall:
+    __slots__ = ("at", "seconds", "coroutine", "frames")
+
+    def __init__(self, at: float, seconds: float, coroutine: str, frames: list[str]) -> None:
+        self.at = at
+        self.seconds = seconds
+        self.coroutine = coroutine
+        """The coroutine that held the loop, or what ran outside of one"""
+        self.frames = frames
+
+
+class Watchdog:
+    """Measures event loop lag all the time and catches what blocks it.
+
+    A task on the loop wakes up every interval and records how late it was.
+    A thread watches those wake ups, and once the loop has been stuck for
+    threshold it takes the loop thread's stack, so the stall can be pinned
+    on the coroutine that was running instead of whatever ran after it."""
+
+    def __init__(self, threshold=STALL_THRESHOLD, interval=TICK_INTERVAL) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread: int | None = None
+        self.caught: tuple[str, list[str]] | None = None
+        """What the thread saw running during the current stall"""
+        self.stalls: deque[Stall] = deque(maxlen=STALLS_KEPT)
+        self.stopped = threading.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Starts watching the running event loop"""
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        threading.Thread(target=self.watch, name="watchdog", daemon=True).start()
+        lag_histogram = metrics.registry.histogram("loop_lag_seconds")
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = loop.time() - expected
+                self.heartbeat = time.monotonic()
+                lag_histogram.observe(lag)
+                if lag >= self.threshold:
+                    self.record(lag)
+        finally:
+            self.stopped.set()
+
+    def record(self, lag: float) -> None:
+        coroutine, frames = self.caught or ("unknown, it ended before it was caught", [])
+        self.caught = None
+        self.stalls.append(Stall(time.time(), lag, coroutine, frames))
+        metrics.registry.count("loop_stalls")
+        print(f"Event loop stalled for {lag * 1000:.0f}ms in {coroutine}", file=sys.stderr)
+        for line in frames:
+            print(f"    {line}", file=sys.stderr)
+
+    def watch(self) -> None:
+        while not self.stopped.wait(self.interval):
+            stuck = time.monotonic() - self.heartbeat - self.interval
+            if stuck < self.threshold or self.caught is not None:
+                continue
+            assert self.loop_thread is not None
+            frames = stack(sys._current_frames().get(self.loop_thread))
+            self.caught = (
+                innermost_coroutine(frames),
+                [frame_name(frame) for frame in frames[-8:]],
+            )
+
+
+class Profiler:
+    """Opt-in sampling profiler for the hooked parts of the bot.
+
+    Wrap a call in `with profiler:` to have the loop thread's stack sampled
+    every interval while the task making the call is the one running. Time
+    the loop spends on other tasks meanwhile, like other games or tasks the
+    call started, isn't counted for it. The samples are written to path in
+    the collapsed stack format flamegraph.pl, inferno and speedscope read,
+    one "outer;...;inner count" line per stack."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.path: str | None = None
+        self.hooked: Counter[asyncio.Task] = Counter()
+        """Tasks in a hooked call: how many hooked calls deep they are"""
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread: int | None = None
+        self.samples: Counter[str] = Counter()
+        self.stopped = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def __enter__(self) -> None:
+        task = asyncio.current_task()
+        if task is not None:
+            self.hooked[task] += 1
+
+    def __exit__(self, *exc) -> None:
+        task = asyncio.current_task()
+        if task is None:
+            return
+        self.hooked[task] -= 1
+        if not self.hooked[task]:
+            del self.hooked[task]
+
+    def running_hooked(self) -> bool:
+        """Whether the task the loop is running is in a hooked call"""
+        assert self.loop is not None
+        return asyncio.current_task(self.loop) in self.hooked
+
+    def start(self, path: str) -> None:
+        """Starts sampling from the thread running the event loop, call it on the loop"""
+        self.path = path
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+
+    def sample(self) -> None:
+        last_write = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            if self.running_hooked():
+                assert self.loop_thread is not None
+                frames = stack(sys._current_frames().get(self.loop_thread))
+                # Waiting in select is the loop being idle, not work. The loop
+                # may have moved on to another task while the stack was taken
+                idle = not frames or frames[-1].f_code.co_name == "select"
+                if not idle and self.running_hooked():
+                    self.samples[";".join(frame_name(frame) for frame in frames)] += 1
+            if time.monotonic() - last_write >= PROFILE_FLUSH:
+                self.write()
+                last_write = time.monotonic()
+        self.write()
+
+    def write(self) -> None:
+        if self.path is None or not self.samples:
+            return
+        with open(self.path, "w") as f:
+            for folded, count in self.samples.copy().items():
+                f.write(f"{folded} {count}\n")
+
+    def stop(self) -> None:
+        """Stops sampling and writes out what was collected"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+watchdog = Watchdog()
+profiler = Profiler()
@@ -1,12 +1,23 @@
 import asyncio
-import json
+import functools
 import random
-from collections import Counter
+from collections import Counter, defaultdict, deque
 
 import disnake
 from disnake.ext import commands
+from disnake.http import Route
 
+import cluster as C
+import distribution as D
+import events as E
+import loopwatch
+import metrics
 import roles as R
+import scheduler as Sch
+import storage as S
+import timers
+import transport as T
+import votes as V
 
 intents = disnake.Intents.default()
 intents.message_content = True
@@ -15,13 +26,28 @@ intents.guilds = True
 intents.members = True  # Required for managing roles
 
 
-command_sync_flags = commands.CommandSyncFlags.default()
-command_sync_flags.sync_commands_debug = True
+cluster = C.Cluster.from_env()
+"""Set when running as one worker of cluster.py, None when running alone"""
 
-bot = commands.InteractionBot(
-    test_guilds=[1012004094564646992, 873251935602499654],
-    command_sync_flags=command_sync_flags,
-)
+if cluster is None or cluster.worker == 0:
+    command_sync_flags = commands.CommandSyncFlags.default()
+    command_sync_flags.sync_commands_debug = True
+else:
+    # Commands are global to the application, one worker syncs them for all
+    command_sync_flags = commands.CommandSyncFlags.none()
+
+if cluster is None:
+    bot = commands.InteractionBot(
+        test_guilds=[1012004094564646992, 873251935602499654],
+        command_sync_flags=command_sync_flags,
+    )
+else:
+    bot = commands.AutoShardedInteractionBot(
+        test_guilds=[1012004094564646992, 873251935602499654],
+        command_sync_flags=command_sync_flags,
+        shard_ids=cluster.shard_ids,
+        shard_count=cluster.shard_count,
+    )
 
 WOLF_KILL_MESSAGES = [
     "You were killed by the wolves",
@@ -35,142 +61,494 @@ VILLAGER_KILL_MESSAGES = [
     "Zeph left a note at your door so you decided to leave",
 ]
 
+START_DELAY = 5
+"""Seconds between handing out roles and the first night"""
+
+MIN_PLAYERS = 3
+"""Fewest players that can be left after dropping unreachable ones to start,
+a werewolf and two villagers"""
+
+MAX_PLAYERS = V.MAX_SELECTS * V.MAX_OPTIONS - 1
+"""Most players in a lobby, so a day vote fits everyone and Skip in its selects"""
+
+# Discord's global limit is per bot token, each worker of a cluster gets its share
+discord_transport = T.ScheduledTransport(
+    T.DiscordTransport(bot),
+    Sch.Scheduler(
+        global_limit=Sch.GLOBAL_LIMIT if cluster is None else cluster.share(Sch.GLOBAL_LIMIT)
+    ),
+)
+
+LOBBY_TTL = 30 * 60
+"""Seconds a lobby can go without anyone joining before it is closed"""
+
+GAME_TTL = 24 * 60 * 60
+"""Seconds a running game can go without any vote activity before it is closed"""
+
+IDLE_PHASES = 4
+"""Phases in a row closing without a confirmed vote before a game is ended"""
+
+MAX_GAMES = 1000
+MAX_GUILD_GAMES = 5
+"""Most lobbies and games that can be open at once, in total and per guild"""
+
 games: dict[int, "Game"] = {}
 """Msg id of the start msg: game object"""
 
+guild_games: Counter[int] = Counter()
+"""Guild id: number of open games"""
+
+LOBBY_UPDATE_INTERVAL = 1.0
+"""Minimum seconds between two edits of the lobby message"""
+
+LOBBY_COMPONENTS = [
+    disnake.ui.Button(label="Join", style=disnake.ButtonStyle.success, custom_id="join"),
+    disnake.ui.Button(label="Start", style=disnake.ButtonStyle.blurple, custom_id="start"),
+]
+
+SEEN_INTERACTIONS = 10_000
+"""Recent interaction ids remembered to drop redelivered ones"""
+
 class GameStartedError(Exception):
     pass
 
 
 class Player:
-    def __init__(self, user: disnake.Member) -> None:
-        self.id = 0
-        self.name = user.global_name
-        self.member: disnake.Member = user
-        self.id = user.id
+    """Per game state of a player, slotted since a process hosts tens of
+    thousands of them. The Discord user is looked up by id when sending."""
+
+    __slots__ = ("id", "name", "transport", "role", "is_alive", "can_dm", "dm_check")
+
+    def __init__(self, id: int, name: str, transport: T.Transport) -> None:
+        self.id = id
+        self.name = name
+        self.transport = transport
         self.role: R.Role
         self.is_alive = True
-        self.ready_event = asyncio.Event()
+        self.can_dm: bool | None = None
+        """Whether a DM got through, None until the lobby check is done"""
+        self.dm_check: asyncio.Task | None = None
 
-        # Vote Handling
-        self.target: Player | None = None
-        self.done = False
-        self.embed_id = disnake.Message
-
-    async def send(self, msg) -> None:
-        await self.member.send(msg)
+    async def send(self, msg: str | None = None, **fields):
+        return await self.transport.send(self, msg, **fields)
 
     async def kill(self, reason):
         self.is_alive = False
-        embed = disnake.Embed(
-            title="You have been killed",
-            description=f"{reason}",
-            color=disnake.Color.red(),
+        await self.send(embed=kill_embed(reason))
+
+
+@functools.cache
+def kill_embed(reason: str) -> disnake.Embed:
+    """Built once per kill message, they come from a short list"""
+    return disnake.Embed(
+        title="You have been killed",
+        description=f"{reason}",
+        color=disnake.Color.red(),
+    )
+
+
+@functools.cache
+def result_embeds(winning_team: str) -> tuple[disnake.Embed, disnake.Embed]:
+    """The win and lose embeds for a winning team"""
+    win_embed = disnake.Embed(
+        title=f"You won",
+        description=f"The {winning_team} were successful",
+        color=disnake.Colour.green(),
+    )
+    lose_embed = disnake.Embed(
+        title=f"You lost",
+        description=f"The {winning_team} won",
+        color=disnake.Colour.red(),
+    )
+    return win_embed, lose_embed
+
+
+def winner(villagers: int, wolves: int) -> str:
+    """The team that has won with this many of each alive, empty if neither yet"""
+    if not wolves:
+        return "Villagers"
+    if villagers <= 1:
+        return "Wolves"
+    return ""
+
+
+def name_list(names: list[str], limit: int) -> str:
+    """Joins names, cut short with "and N more" to fit in limit characters"""
+    text = ", ".join(names)
+    if len(text) <= limit:
+        return text
+    room = limit - len(f", and {len(names)} more")
+    shown: list[str] = []
+    for name in names:
+        room -= len(name) + 2
+        if room < 0:
+            break
+        shown.append(name)
+    return ", ".join(shown) + f", and {len(names) - len(shown)} more"
+
+
+def lobby_text(names: list[str], unreachable: list[str] | None = None) -> str:
+    header = f"Current Players: {len(names)}\n"
+    warning = ""
+    if unreachable:
+        warning = (
+            f"\n⚠️ Can't DM {name_list(unreachable, 500)}, allow DMs from server members "
+            "before the game starts or you will be left out"
         )
-        await self.member.send(embed=embed)
+    return header + name_list(names, V.MAX_CONTENT - len(header) - len(warning)) + warning
 
 
 class Game:
     def __init__(
-        self, channel: disnake.TextChannel, start_message: disnake.Message
+        self,
+        channel: disnake.TextChannel,
+        start_message: disnake.PartialMessage | disnake.Message,
+        transport: T.Transport | None = None,
+        seed: int | None = None,
     ) -> None:
+        """seed: seeds the role assignment, random if None"""
         self.channel = channel
+        self.api_calls: Counter[str] = Counter()
+        """Requests this game has made, by kind"""
+        self.transport = (transport or discord_transport).metered(
+            channel.guild.id, self.api_calls
+        )
+        self.start_message = start_message
         self.start_message_id = start_message.id
         self.game_running = False
         self.id = channel.guild.id
         self.players: dict[int, Player] = {}
         self.config = load_config(channel.guild.id)
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.rng = random.Random(self.seed)
+        self.phase_rng = self.rng.getstate()
+        """State of rng when the current phase began, a resumed phase draws from it again"""
+
+        # Live indexes, kept up to date by index_roles and mark_dead
+        self.alive: dict[int, Player] = {}
+        self.alive_teams: defaultdict[str, dict[int, Player]] = defaultdict(dict)
 
         self.players_to_kill: dict[Player, str] = {}
         self.safe_players: list[Player] = []
         self.winning_team = ""
+        self.phase = "lobby"
+        self.start_delay = START_DELAY
+        self.broadcast_channel = None
+        """Where public news is posted once instead of DMed to everyone"""
+
+        # Resuming after a restart
+        self.vote_results: dict[str, int | None] = {}
+        """Vote id: chosen player id of the votes finished this phase"""
+        self.restored_votes: dict[str, S.Snapshot] = {}
+        self.notices: tuple[list[tuple[int, str]], str] | None = None
+        """Deaths of the phase that just ended and their announcement, until sent"""
+
+        # Lobby message updates, coalesced like vote tallies
+        self.lobby_shown = ""
+        self.lobby_updates = timers.Coalescer(self.update_lobby, LOBBY_UPDATE_INTERVAL)
+        self.closing: asyncio.Task | None = None
+
+        # Eviction
+        self.sessions: set[V.VoteSession] = set()
+        self.task: asyncio.Task | None = None
+        self.last_active = 0.0
+        self.expiry: timers.Timer | None = None
+        self.voted = False
+        """Whether a vote of the current phase was confirmed by anyone"""
+        self.idle_phases = 0
+
+    def touch(self) -> None:
+        """Marks the game as active, pushing back its eviction"""
+        self.last_active = asyncio.get_running_loop().time()
+
+    def request_lobby_update(self) -> None:
+        """Schedules a lobby edit, a burst of joins is shown by one edit per interval"""
+        self.lobby_updates.request()
+
+    async def update_lobby(self) -> bool:
+        """Edits the player list into the lobby message. Like the vote tally
+        it is best effort, a failed edit is left for the next join to fix
+        Returns:
+            bool: whether the list had changed since the last edit"""
+        text = lobby_text(
+            [str(p.name) for p in self.players.values()],
+            [str(p.name) for p in self.players.values() if p.can_dm is False],
+        )
+        if text == self.lobby_shown:
+            return False
+        try:
+            await self.transport.edit(self.start_message, content=text)
+        except disnake.HTTPException:
+            return True
+        self.lobby_shown = text
+        return True
+
+    async def close_lobby(self) -> None:
+        """Takes the Join and Start buttons off an evicted lobby"""
+        try:
+            await self.transport.edit(
+                self.start_message, content="This lobby was closed", components=[]
+            )
+        except disnake.HTTPException:
+            pass
+
+    def add_player(self, user: disnake.Member) -> Player:
+        """Adds a player to the lobby and opens their DM channel in the background"""
+        player = Player(user.id, user.global_name or user.name, self.transport)
+        self.players[user.id] = player
+        player.dm_check = asyncio.create_task(self.check_dm(player))
+        return player
+
+    async def check_dm(self, player: Player) -> None:
+        """Opens the DM channel while the lobby fills instead of in the burst of
+        role cards, and finds out early if the player has DMs turned off"""
+        try:
+            await player.send("You joined a werewolf game, your role will be sent here")
+        except disnake.HTTPException:
+            # Forbidden when their DMs are off, but a DM failing any other way
+            # would lose their role card just the same
+            player.can_dm = False
+            self.request_lobby_update()
+        else:
+            player.can_dm = True
+
+    async def drop_unreachable(self, inter: disnake.MessageInteraction) -> None:
+        """Leaves out the players that can't be DMed before roles are handed out"""
+        checks = [p.dm_check for p in self.players.values() if p.dm_check is not None]
+        if checks:
+            await asyncio.gather(*checks, return_exceptions=True)
+        for player in self.players.values():
+            player.dm_check = None
+        unreachable = [p for p in self.players.values() if p.can_dm is False]
+        for player in unreachable:
+            del self.players[player.id]
+        if unreachable:
+            names = ", ".join(str(p.name) for p in unreachable)
+            await inter.send(f"{names} left out, DMs to them don't get through")
+
+    def check_idle(self) -> None:
+        ttl = GAME_TTL if self.game_running else LOBBY_TTL
+        idle = asyncio.get_running_loop().time() - self.last_active
+        if idle >= ttl:
+            evict(self)
+        else:
+            self.expiry = timers.timer_wheel.schedule(ttl - idle, self.check_idle)
 
     async def start(self, inter: disnake.MessageInteraction) -> None:
+        with loopwatch.profiler:
+            if await self.prepare(inter):
+                await self.run(self.play(inter))
+
+    async def prepare(self, inter: disnake.MessageInteraction) -> bool:
+        """Closes the lobby and leaves out the players that can't be DMed
+        Returns:
+            bool: whether enough players are left to play"""
         if self.game_running:
             raise (GameStartedError("Game has already started"))
         self.game_running = True
+        await self.drop_unreachable(inter)
+        if len(self.players) < MIN_PLAYERS:
+            problem = f"Not enough players who accept DMs to start, a game needs {MIN_PLAYERS}"
+        elif self.decided_setup():
+            problem = "The roles this config deals would end the game before it starts"
+        else:
+            return True
+        # Back to an open lobby the dropped players can rejoin
+        self.game_running = False
+        self.seed = random.getrandbits(64)
+        self.rng = random.Random(self.seed)
+        self.request_lobby_update()
+        await self.transport.post(self.channel, problem)
+        return False
+
+    def decided_setup(self) -> bool:
+        """Whether the setup assign_roles is about to deal already has a winner,
+        e.g. a config with as many werewolves as players"""
+        rng = random.Random()
+        rng.setstate(self.rng.getstate())
+        counts = D.setup(peek_config(self.id), len(self.players), rng)
+        teams: Counter[str] = Counter()
+        for name, count in counts.items():
+            teams[R.ROLE_REGISTRY[name].team] += count
+        return bool(winner(teams["Villagers"], teams["Wolves"]))
+
+    async def resume(self) -> None:
+        """Carries on a game restored from its snapshot"""
+        self.log("resume", phase=self.phase)
+        await self.run(self.play_resumed())
+
+    async def play_resumed(self) -> None:
+        if self.notices is not None:
+            # Stopped while telling everyone who died
+            await self.send_notices()
+        await self.play_phases()
+
+    async def run(self, play) -> None:
+        self.task = asyncio.current_task()
+        self.touch()
+        try:
+            await play
+        except asyncio.CancelledError:
+            # Shutting down, keep the snapshot to resume from
+            raise
+        except Exception:
+            store.delete_snapshot(self.start_message_id)
+            raise
+        finally:
+            # Also cleans up games that crashed or were evicted mid-phase
+            stop_game(self)
+
+    async def play(self, inter: disnake.MessageInteraction) -> None:
+        await self.open_broadcast()
         await self.assign_roles()
+        self.phase = "night"
+        self.phase_rng = self.rng.getstate()
+        self.save()
         await inter.send("Roles assigned check DM's")
-        await asyncio.sleep(5)
+        await asyncio.sleep(self.start_delay)
+        await self.play_phases()
 
+    async def play_phases(self) -> None:
         while self.game_running:
-            await self.night_phase()
-            if self.game_running:
-                await self.day_phase()
-        
+            if self.idle_phases >= IDLE_PHASES:
+                await self.abandon()
+                return
+            self.log("phase", phase=self.phase)
+            self.voted = False
+            with metrics.registry.timed("phase_seconds", phase=self.phase):
+                if self.phase == "night":
+                    await self.night_phase()
+                else:
+                    await self.day_phase()
+            self.idle_phases = 0 if self.voted else self.idle_phases + 1
+        await self.finish()
+
+    async def abandon(self) -> None:
+        """Ends a game everyone has stopped playing, without a winner"""
+        self.game_running = False
+        await self.transport.post(
+            self.channel, f"Game ended, nobody voted for {IDLE_PHASES} phases in a row"
+        )
+        store.delete_snapshot(self.start_message_id)
+        self.log("end", winner=self.winning_team)
+
+    async def finish(self) -> None:
         winning_players = [p for p in self.players.values() if p.role.team == self.winning_team]
         losing_players = [p for p in self.players.values() if p.role.team != self.winning_team]
-        win_embed = disnake.Embed(
-                title=f"You won",
-                description=f"The {self.winning_team} were successful",
-                color=disnake.Colour.green(),
-            )
-        lose_embed = disnake.Embed(
-            title=f"You lost",
-            description=f"The {self.winning_team} won",
-            color=disnake.Colour.red(),
-        )
+        win_embed, lose_embed = result_embeds(self.winning_team)
+        role_embed = self.roles_embed()
+
+        if self.broadcast_channel is not None:
+            role_embed.title = f"The {self.winning_team} won"
+            await self.transport.post(self.broadcast_channel, embed=role_embed)
+        else:
+
+            async def send_result(player: Player, result_embed: disnake.Embed) -> None:
+                await player.send(embed=result_embed)
+                await player.send(embed=role_embed, priority=T.Priority.COSMETIC)
+
+            async with asyncio.TaskGroup() as tg:
+                for player in winning_players:
+                    tg.create_task(send_result(player, win_embed))
+                for player in losing_players:
+                    tg.create_task(send_result(player, lose_embed))
         
-        role_embed = disnake.Embed(
-            title = "Roles"
+        store.record_game(
+            self.id,
+            self.winning_team,
+            [(p.id, p.role.name, p.role.team, p.is_alive) for p in self.players.values()],
         )
-        for p in self.players.values():
-            role_embed.add_field(name=p.name, value=p.role.name, inline=True)
-                    
-        
-        async with asyncio.TaskGroup() as tg:
-            for player in winning_players:
-                tg.create_task(player.member.send(embed=win_embed))
-                tg.create_task(player.member.send(embed=role_embed))
-            for player in losing_players:
-                tg.create_task(player.member.send(embed=lose_embed))
-                tg.create_task(player.member.send(embed=role_embed))
-        
-        stop_game(self)
-        
+        store.delete_snapshot(self.start_message_id)
+        self.log("end", winner=self.winning_team)
 
     async def kill_players(self, msg: str):
-        killed_any = False
-        for player in self.players_to_kill.keys():
-            if player not in self.safe_players:
-                await player.kill(self.players_to_kill[player])
-                self.win_check()
-                if self.config["Villager"]["dead_see_roles"] and self.game_running:
-                    embed = disnake.Embed(
-                        title = "Roles"
-                    )
-                    for p in self.players.values():
-                        embed.add_field(name=p.name, value=p.role.name, inline=True)
-                    await player.member.send(embed=embed)
-                
-                killed_any =True
-                recipients = [p for p in self.players.values() if p != player]
-
-                await self.message_all(recipients, msg.format(name=player.name))
-        if not killed_any:
-            await self.message_all([p for p in self.players.values() if p.is_alive], "No one was killed")
+        deaths = self.resolve_kills()
+        self.notices = ([(player.id, reason) for player, reason in deaths.items()], msg)
+        self.end_phase()
+        await self.send_notices()
+
+    async def send_notices(self) -> None:
+        """Sends the kill notices, they stay in the snapshot until they are out"""
+        assert self.notices is not None
+        deaths, msg = self.notices
+        await self.notify_kills({self.players[player_id]: reason for player_id, reason in deaths}, msg)
+        self.notices = None
+        self.save()
+
+    def end_phase(self) -> None:
+        """Moves on to the next phase and saves, so a restart doesn't replay this one"""
+        self.phase = "day" if self.phase == "night" else "night"
+        self.vote_results = {}
+        self.phase_rng = self.rng.getstate()
+        self.save()
+
+    def resolve_kills(self) -> dict[Player, str]:
+        """Applies the pending kills that weren't protected and checks for a win
+        Returns:
+            dict: the players that died and the reason they were given"""
+        deaths = {
+            player: reason
+            for player, reason in self.players_to_kill.items()
+            if player not in self.safe_players
+        }
+        for player, reason in deaths.items():
+            self.mark_dead(player)
+            self.log("death", player=player.id, reason=reason)
+        if deaths:
+            self.win_check()
         self.players_to_kill = {}
         self.safe_players = []
+        return deaths
 
-    async def assign_roles(self) -> None:
-        config = load_config(self.id)
-        roles = parse_config(config)
-        players = list(self.players.values())
+    async def notify_kills(self, deaths: dict[Player, str], msg: str):
+        """Tells the dead how they died and everyone else who died, all at once"""
+        if not deaths:
+            await self.announce(list(self.alive.values()), "No one was killed")
+            return
 
-        # Trim roles safely
-        roles = trim_roles(roles, players)
+        roles_embed = None
+        if self.config["Villager"]["dead_see_roles"] and self.game_running:
+            roles_embed = self.roles_embed()
 
-        # Fill with villagers if needed
-        if len(roles) < len(players):
-            roles.extend(
-                R.ROLE_REGISTRY["Villager"]() for _ in range(len(players) - len(roles))
-            )
+        async def notify_dead(player: Player, reason: str) -> None:
+            # Both go to the same DM, the roles have to come after the death notice
+            await player.kill(reason)
+            if roles_embed:
+                await player.send(embed=roles_embed)
 
-        # Shuffle and assign
-        random.shuffle(players)
-        random.shuffle(roles)
-        for player, role in zip(players, roles):
-            player.role = role
+        async with asyncio.TaskGroup() as tg:
+            for player, reason in deaths.items():
+                tg.create_task(notify_dead(player, reason))
+            if self.broadcast_channel is not None:
+                announcement = "\n".join(msg.format(name=dead.name) for dead in deaths)
+                tg.create_task(self.transport.post(self.broadcast_channel, announcement))
+                return
+            for player in self.players.values():
+                announcement = "\n".join(
+                    msg.format(name=dead.name) for dead in deaths if dead != player
+                )
+                if announcement:
+                    tg.create_task(player.send(announcement))
+
+    def roles_embed(self) -> disnake.Embed:
+        embed = disnake.Embed(title="Roles")
+        V.add_fields(embed, [(p.name, p.role.name) for p in self.players.values()])
+        return embed
+
+    async def assign_roles(self) -> None:
+        config = peek_config(self.id)
+        self.log(
+            "start",
+            seed=self.seed,
+            guild=self.id,
+            config={role: dict(options) for role, options in config.items()},
+            players=[[p.id, p.name] for p in self.players.values()],
+        )
+        counts = D.setup(config, len(self.players), self.rng)
+        for player, name in zip(self.players.values(), D.deal(counts, self.rng)):
+            player.role = R.ROLE_REGISTRY[name]()
+        self.index_roles()
+        self.log("roles", roles=[[p.id, p.role.name] for p in self.players.values()])
 
         # Role-specific setup
         async with asyncio.TaskGroup() as tg:
@@ -178,32 +556,96 @@ class Game:
                 tg.create_task(player.role.assign_action(player, self))
 
     async def night_phase(self):
-        # Reset state
-        self.wolf_kills = []
-        self.wolves_have_killed = False
-        # Collect tasks for all alive players
+        self.phase = "night"
+        choices = await self.night_choices()
+        reports = self.resolve_night(choices)
 
         async with asyncio.TaskGroup() as tg:
-            tg.create_task(self.wolf_vote())
-            for player in self.players.values():
-                tg.create_task(player.role.night_action(player, self))
-        print("FinishedNightActions")
-
+            for voters, report in reports:
+                for player in voters:
+                    tg.create_task(player.send(report))
         await self.kill_players("{name} was killed")
-        print("FinishedNightPhase")
 
-    async def wolf_vote(self):
-        wolves = [
-            p for p in self.players.values() if p.role.team == "Wolves" and p.is_alive
-        ]
-        targets = [
-            p for p in self.players.values() if p.role.team != "Wolves" and p.is_alive
+    async def night_choices(self) -> list[tuple[R.NightAction, list[Player], Player]]:
+        """Opens every night vote at once, one per player, or one per shared
+        action for all of its players, and waits for them all to close
+        Returns:
+            list: the action, its voters and who they chose, for every vote that chose"""
+        votes: dict[str, tuple[R.NightAction, list[Player]]] = {}
+        sleepers: defaultdict[str, list[Player]] = defaultdict(list)
+        async with asyncio.TaskGroup() as tg:
+            for player in self.alive.values():
+                action = player.role.night_action
+                if action is None:
+                    if player.role.sleep_message:
+                        sleepers[player.role.sleep_message].append(player)
+                    continue
+                vote_id = action.shared or str(player.id)
+                votes.setdefault(vote_id, (action, []))[1].append(player)
+
+            for msg, players in sleepers.items():
+                tg.create_task(self.announce(players, msg))
+
+            tasks = {
+                vote_id: tg.create_task(
+                    self.vote(
+                        action.prompt,
+                        voters[0].role.colour,
+                        vote_id,
+                        voters,
+                        action.options(voters[0], self),
+                        update=action.shared is not None,
+                    )
+                )
+                for vote_id, (action, voters) in votes.items()
+            }
+        return [
+            (action, voters, chosen)
+            for vote_id, (action, voters) in votes.items()
+            if (chosen := tasks[vote_id].result()) is not None
         ]
-        to_kill = await self.vote(
-            "Chose a player to kill", disnake.Colour.red(), "wolf", wolves, targets
-        )
-        if to_kill:
-            self.players_to_kill[to_kill] = random.choice(WOLF_KILL_MESSAGES)
+
+    def resolve_night(
+        self, choices: list[tuple[R.NightAction, list[Player], Player]]
+    ) -> list[tuple[list[Player], str]]:
+        """Applies the night's choices in one pass, protections before kills
+        before inspections
+        Returns:
+            list: the players to tell and what to tell them"""
+        reports = []
+        for action, voters, chosen in sorted(choices, key=lambda choice: choice[0].action):
+            self.log(
+                action.action.name.lower(),
+                voters=[p.id for p in voters],
+                target=chosen.id,
+            )
+            if action.action == R.Action.PROTECT:
+                self.safe_players.append(chosen)
+            elif action.action == R.Action.KILL and chosen not in self.safe_players:
+                self.players_to_kill[chosen] = self.rng.choice(WOLF_KILL_MESSAGES)
+            if action.report:
+                reports.append(
+                    (voters, action.report.format(name=chosen.name, role=chosen.role.name))
+                )
+        return reports
+
+    async def open_broadcast(self) -> None:
+        """Picks where public news goes from the Villager broadcast option:
+        0 DMs every player, 1 posts in the game's channel, 2 in a thread of it"""
+        mode = self.config["Villager"].get("broadcast", 0)
+        if mode == 1:
+            self.broadcast_channel = self.channel
+        elif mode == 2:
+            self.broadcast_channel = await self.transport.create_thread(
+                self.channel, "Werewolf"
+            )
+
+    async def announce(self, players: list[Player], msg: str):
+        """Posts public news once to the broadcast channel, or DMs it to players"""
+        if self.broadcast_channel is not None:
+            await self.transport.post(self.broadcast_channel, msg)
+        else:
+            await self.message_all(players, msg)
 
     async def message_all(self, players: list[Player], msg: str):
         async with asyncio.TaskGroup() as tg:
@@ -211,7 +653,8 @@ class Game:
                 tg.create_task(player.send(msg))
 
     async def day_phase(self):
-        alive = [p for p in self.players.values() if p.is_alive]
+        self.phase = "day"
+        alive = list(self.alive.values())
 
         voted = await self.vote(
             "Choose a player to exile",
@@ -221,28 +664,97 @@ class Game:
             alive,
             True,
             bool(self.config["Villager"]["can_skip_vote"]),
+            channel=self.broadcast_channel,
         )
 
         if voted:
-            self.players_to_kill[voted] = random.choice(VILLAGER_KILL_MESSAGES)
-        else:
-            await self.message_all(alive, "No one was killed")
+            self.players_to_kill[voted] = self.rng.choice(VILLAGER_KILL_MESSAGES)
 
         await self.kill_players("{name} was voted out")
 
-        print("FinishedDayPhase")
+    def timeout(self) -> float | None:
+        """Seconds players get to vote in the current phase, None for no limit"""
+        seconds = self.config["Villager"].get(f"{self.phase}_seconds", 0)
+        return seconds or None
+
+    def index_roles(self) -> None:
+        """Builds the alive and team indexes once roles are handed out"""
+        self.alive = {}
+        self.alive_teams.clear()
+        for player in self.players.values():
+            if player.is_alive:
+                self.alive[player.id] = player
+                self.alive_teams[player.role.team][player.id] = player
+
+    def log(self, event: str, **fields) -> None:
+        if event_log is not None:
+            event_log.record(self.start_message_id, event, **fields)
+
+    def save(self) -> None:
+        store.save_snapshot(self.start_message_id, self.snapshot)
+
+    def save_vote(self, session: V.VoteSession) -> None:
+        store.save_vote(self.start_message_id, session.vote_id, session.snapshot)
+
+    def forget_vote(self, session: V.VoteSession) -> None:
+        store.delete_vote(self.start_message_id, session.vote_id)
+
+    def snapshot(self) -> S.Snapshot:
+        """Serialisable state of the game between two votes"""
+        return {
+            "guild_id": self.id,
+            "channel_id": self.channel.id,
+            "start_message_id": self.start_message_id,
+            "phase": self.phase,
+            "winning_team": self.winning_team,
+            "broadcast_channel_id": getattr(self.broadcast_channel, "id", None),
+            "players": [
+                [p.id, p.name, p.role.name, p.is_alive] for p in self.players.values()
+            ],
+            "vote_results": self.vote_results,
+            "notices": self.notices,
+            "seed": self.seed,
+            "rng": self.phase_rng,
+        }
+
+    def restore(self, snapshot: S.Snapshot, votes: list[S.Snapshot]) -> None:
+        """Loads a snapshot into a game whose players have already been added"""
+        self.phase = snapshot["phase"]
+        self.winning_team = snapshot["winning_team"]
+        self.game_running = not self.winning_team
+        for player_id, name, role, alive in snapshot["players"]:
+            player = self.players[player_id]
+            player.name = name
+            player.role = R.ROLE_REGISTRY[role]()
+            player.is_alive = alive
+        self.index_roles()
+        self.vote_results = snapshot["vote_results"]
+        # Snapshots saved before notices were kept don't have them
+        self.notices = snapshot.get("notices")
+        self.restored_votes = {vote["vote_id"]: vote for vote in votes}
+        if "rng" in snapshot:
+            # Kill reasons are drawn again the same way as before the restart
+            self.seed = snapshot["seed"]
+            version, state, gauss = snapshot["rng"]
+            self.phase_rng = (version, tuple(state), gauss)
+            self.rng.setstate(self.phase_rng)
+
+        broadcast = snapshot["broadcast_channel_id"]
+        if broadcast == self.channel.id:
+            self.broadcast_channel = self.channel
+        elif broadcast is not None:
+            self.broadcast_channel = self.transport.messageable(broadcast)
+
+    def mark_dead(self, player: Player) -> None:
+        player.is_alive = False
+        self.alive.pop(player.id, None)
+        self.alive_teams[player.role.team].pop(player.id, None)
 
     def win_check(self):
-        roles = [p.role.team for p in self.players.values() if p.is_alive]
-        teams = Counter(roles)
-
-        if teams["Villagers"] == 1:
+        winning_team = winner(len(self.alive_teams["Villagers"]), len(self.alive_teams["Wolves"]))
+        if winning_team:
             self.game_running = False
-            self.winning_team = "Wolves"
-        
-        if teams["Wolves"] == 0:
-            self.game_running = False
-            self.winning_team = "Villagers"
+            self.winning_team = winning_team
 
     async def vote(
         self,
@@ -253,6 +765,8 @@ class Game:
         options: list[Player],
         update=True,
         skippable=False,
+        timeout: float | None = None,
+        channel=None,
     ) -> Player | None:
         """Creates a vote of players and returns the winner of the vote
         Args:
@@ -265,126 +779,48 @@ class Game:
             role: wether or not this is the roll class calling the vote
             update: wether or not the vote call an update function
             skippable: wether the vote can be skipped
+            timeout: seconds before the vote closes with the votes confirmed so far,
+                defaults to the limit for the current phase
+            channel: post the vote once in this channel instead of DMing each voter
         Returns:
             player: the player object of the player that was chosen or none if tie"""
 
-        embed_ids: list[disnake.Message] = []
-        targets: dict[str, str] = {p.name: str(p.id) for p in options}
-        if skippable:
-            targets["Skip"] = "0"
-        votes: dict[int, int | None] = {}  # voter_id -> target_id
-        confirmed: list[int] = []  # voter_id
-        vote_event = asyncio.Event()
-
-        for player in voters:
-            votes[player.id] = None
-
-        embed = disnake.Embed(title=title, colour=colour)
-
-        if update:
-            for voter in voters:
-                embed.add_field(name=voter.name, value="No Vote", inline=True)
-
-        async with asyncio.TaskGroup() as tg:
-            for voter in voters:
-                embed_ids.append(await voter.member.send(embed=embed))
-                await voter.member.send(
-                    components=[
-                        disnake.ui.StringSelect(
-                            options=targets,
-                            custom_id=f"Select {vote_id} {self.start_message_id} {voter.id}",
-                        ),
-                        disnake.ui.Button(
-                            label="Confirm",
-                            style=disnake.ButtonStyle.success,
-                            custom_id=f"Confirm {vote_id} {self.start_message_id} {voter.id}",
-                        ),
-                    ]
-                )
-
-        async def update_message():
-            embed = disnake.Embed(title=title, colour=colour)
-            nonlocal votes
-            nonlocal confirmed
-
-            value: str
-            for player in voters:
-                if votes[player.id] is None:
-                    value = "No Vote"
-                elif votes[player.id] == 0:
-                    value = "Skip"
-                else:
-                    value = self.players[votes[player.id]].name
-
-                if player.id in confirmed:
-                    value = value + " ✅"
-
-                embed.add_field(name=player.name, value=value, inline=True)
-            async with asyncio.TaskGroup() as tg:
-                for embed_id in embed_ids:
-                    tg.create_task(embed_id.edit(embed=embed))
-
-        @bot.listen("on_dropdown")
-        async def handle_dropdown(inter: disnake.MessageInteraction):
-            
-            
-            nonlocal votes
-
-            if not inter.data.custom_id.startswith(f"Select {vote_id}"):
-                return
-            await inter.response.defer(with_message=False)
-            _, _, game_id, voter_id = inter.data.custom_id.split(" ")
-            if int(game_id) != self.start_message_id:
-                return
-            if not inter.data.values:
-                return
-            votes[int(voter_id)] = int(inter.data.values[0])
-            
-            if update:
-                await update_message()
-
-        @bot.listen("on_button_click")
-        async def handle_confirm(inter: disnake.MessageInteraction):
-            nonlocal votes
-            nonlocal confirmed
-            if not inter.data.custom_id.startswith(f"Confirm {vote_id}"):
-                
-                return
-            _, _, game_id, voter_id = inter.data.custom_id.split(" ")
-            if int(game_id) != self.start_message_id:
-                return
-
-            if votes[int(voter_id)] == 0:
-                await inter.send("Skipped vote")
-                confirmed.append(int(voter_id))
-            elif votes[int(voter_id)]:
-                await inter.send(f"Selected {self.players[votes[int(voter_id)]].name}")
-                confirmed.append(int(voter_id))
-            else:
-                await inter.send("Please select an option", ephemeral=True)
-            if update:
-                await update_message()
-            # when all voters have picked, trigger event
-            if len(confirmed) == len(voters):
-                vote_event.set()
-
-        await asyncio.wait_for(vote_event.wait(), timeout=None)
-
-        bot.remove_listener(handle_dropdown, "on_dropdown")
-        bot.remove_listener(handle_confirm, "on_button_click")
-
-        if not votes:
-            return None
-        tally = Counter(votes.values())
-        max_votes = max(tally.values())
-        winners = [target for target, count in tally.items() if count == max_votes]
-
-        if len(winners) > 1:
-            return None
-
-        if winners[0] == 0:
-            return None
-        return self.players[winners[0]]
+        if vote_id in self.vote_results:
+            # Already decided before a restart
+            chosen = self.vote_results[vote_id]
+            return None if chosen is None else self.players[chosen]
+
+        session = V.VoteSession(
+            self,
+            title,
+            colour,
+            vote_id,
+            voters,
+            options,
+            update,
+            skippable,
+            timeout=timeout if timeout is not None else self.timeout(),
+            channel=channel,
+        )
+        restored = self.restored_votes.pop(vote_id, None)
+        if restored is not None:
+            session.restore(restored)
+        with metrics.registry.timed("vote_seconds", phase=self.phase), loopwatch.profiler:
+            result = await session.run()
+        if session.confirmed:
+            self.voted = True
+        self.log(
+            "vote",
+            vote=vote_id,
+            result=None if result is None else result.id,
+            timed_out=session.timed_out,
+            confirmed=[
+                [voter_id, session.votes[voter_id]] for voter_id in sorted(session.confirmed)
+            ],
+        )
+        self.vote_results[vote_id] = None if result is None else result.id
+        self.save()
+        return result
 
 
 # Config Handling
@@ -392,73 +828,43 @@ class Game:
 
 def load_config(guild_id: int) -> dict[str, dict[str, int]]:
     """Loads config for a guild, falling back to a default if missing/corrupt."""
-    try:
-        with open(f"{guild_id}.json", "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
+    config = store.load(guild_id)
+    if config is None:
         return gen_config(guild_id)
+    return config
 
 
-def gen_config(id: int) -> dict[str, dict[str, int]]:
+def peek_config(guild_id: int) -> dict[str, dict[str, int]]:
+    """Like load_config without copying it, for callers that only read it."""
+    config = store.peek(guild_id)
+    if config is None:
+        return gen_config(guild_id)
+    return config
+
+
+def default_config() -> dict[str, dict[str, int]]:
     config = {}
     for role_cls in R.ROLE_REGISTRY.values():
         role = role_cls()
         config[role.name] = role.config.copy()
+    return config
 
+
+def gen_config(id: int) -> dict[str, dict[str, int]]:
+    config = default_config()
     save_config(id, config)
     return config
 
 
 def save_config(guild_id: int, config: dict[str, dict[str, int]]) -> None:
-    """Saves config back to disk."""
-    with open(f"{guild_id}.json", "w") as f:
-        json.dump(config, f, indent=4)
-
+    """Saves config, writing it back to the store in the background."""
+    store.save(guild_id, config)
 
-# Role Logic
-def trim_roles(roles: list[R.Role], players: list[Player]) -> list[R.Role]:
-    """Trim roles to match player count, always ensuring at least one Werewolf."""
-    max_roles = len(players)
 
-    # Find all werewolves in the roles
-    werewolves = [r for r in roles if r.name == "Werewolf"]
+store = S.Store(S.SqliteBackend("werewolf.db"), default_config)
 
-    if not werewolves:
-        # No werewolf in config? Inject one
-        werewolves = [R.ROLE_REGISTRY["Werewolf"]()]
-        roles.append(werewolves[0])
-
-    # Pick at least one werewolf
-    chosen = [random.choice(werewolves)]
-    # Fill the rest randomly, excluding the chosen werewolf
-    remaining = [r for r in roles if r not in chosen]
-
-    if len(roles) > max_roles:
-        extra = random.sample(remaining, max_roles - len(chosen))
-        chosen.extend(extra)
-    else:
-        chosen.extend(remaining)
-    return chosen
-
-
-def parse_config(config: dict[str, dict[str, int]]) -> list[R.Role]:
-    """Converts config file into list of role objects
-
-    Args:
-        config (dict): the loaded config file to generate from
-    Returns:
-        list: list of role objects"""
-    roles = []
-    for role_def in config.keys():
-        if role_def not in R.ROLE_REGISTRY:
-            raise ValueError(f"Unknown role: {role_def}")
-
-        count = config[role_def]["count"]
-
-        if random.randint(0, 100) <= config[role_def]["chance"]:
-            for _ in range(count):
-                roles.append(R.ROLE_REGISTRY[role_def]())
-    return roles
+event_log: E.EventLog | None = E.EventLog("events.jsonl")
+"""Where every game's events are appended for replay.py, None to turn it off"""
 
 
 @bot.slash_command(description="Starts the werwolf game")
@@ -467,27 +873,25 @@ async def start(inter: disnake.ApplicationCommandInteraction):
         await inter.send(str(type(inter.channel)))
         return
 
-    msg = await inter.channel.send(
-        "Current Players: 1",
-        components=[
-            disnake.ui.Button(
-                label="Join", style=disnake.ButtonStyle.success, custom_id="join"
-            ),
-            disnake.ui.Button(
-                label="Start", style=disnake.ButtonStyle.blurple, custom_id="start"
-            ),
-        ],
-    )
+    if len(games) >= MAX_GAMES or guild_games[inter.channel.guild.id] >= MAX_GUILD_GAMES:
+        await inter.send("Too many games running, try again later", ephemeral=True)
+        return
+
+    with loopwatch.profiler:
+        text = lobby_text([inter.user.global_name or inter.user.name])
+        msg = await inter.channel.send(text, components=LOBBY_COMPONENTS)
 
-    games[msg.id] = Game(inter.channel, msg)
-    games[msg.id].players[inter.user.id] = Player(inter.user)  # pyright: ignore[reportArgumentType]
-    await inter.send("Created & joined game", ephemeral=True)
+        game = Game(inter.channel, msg)
+        game.lobby_shown = text
+        add_game(game)
+        game.add_player(inter.user)  # pyright: ignore[reportArgumentType]
+        await inter.send("Created & joined game", ephemeral=True)
 
 
 async def autocomp_roles(inter: disnake.ApplicationCommandInteraction, user_input: str):
     if not isinstance(inter.channel, disnake.channel.TextChannel):
         return []
-    config = load_config(inter.channel.guild.id)
+    config = peek_config(inter.channel.guild.id)
     return [role for role in config if user_input.lower() in role.lower()]
 
 
@@ -496,7 +900,7 @@ async def autocomp_parameter(
 ):
     if not isinstance(inter.channel, disnake.channel.TextChannel):
         return []
-    config = load_config(inter.channel.guild.id)
+    config = peek_config(inter.channel.guild.id)
 
     role = inter.filled_options.get("role")
     if not role or role not in config:
@@ -528,17 +932,19 @@ async def config(
     id = inter.channel.guild.id
     config = load_config(id)
 
-    if value == None:
-        await inter.send(
-            f"{role}: {parameter.title()} is {config[role][parameter]}", ephemeral=True
-        )
-        return
-
     if role not in config:
         await inter.send(f"Unknown role {role}", ephemeral=True)
+        return
 
     if parameter not in config[role]:
         await inter.send(f"Unknown parameter {parameter}", ephemeral=True)
+        return
+
+    if value == None:
+        await inter.send(
+            f"{role}: {parameter.title()} is {config[role][parameter]}", ephemeral=True
+        )
+        return
 
     config[role][parameter] = value
 
@@ -546,45 +952,282 @@ async def config(
     await inter.send(f"Changed {role}: {parameter.title()} to {value}", ephemeral=True)
 
 
+class SeenInteractions:
+    """Remembers the ids of recent interactions so a redelivered one is only handled once"""
+
+    def __init__(self, size=SEEN_INTERACTIONS) -> None:
+        self.ids: set[int] = set()
+        self.order: deque[int] = deque()
+        self.size = size
+
+    def first(self, interaction_id: int) -> bool:
+        """Returns whether this is the first time the interaction has been seen"""
+        if interaction_id in self.ids:
+            return False
+        self.ids.add(interaction_id)
+        self.order.append(interaction_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+
+seen_interactions = SeenInteractions()
+
+
 @bot.listen("on_button_click")
 async def handle_button_click(inter: disnake.MessageInteraction):
-    if inter.data.custom_id == "join":
-        if inter.user.id in games[inter.message.id].players.keys():
-            await inter.send("Already in game", ephemeral=True)
-            return
-        games[inter.message.id].players[inter.user.id] = Player(inter.user)  # pyright: ignore[reportArgumentType]
-        await inter.send("Joined", ephemeral=True)
-        players = len(games[inter.message.id].players)
-        await inter.message.edit(
-            f"Current Players: {players}",
-            components=[
-                disnake.ui.Button(
-                    label="Join", style=disnake.ButtonStyle.success, custom_id="join"
-                ),
-                disnake.ui.Button(
-                    label="Start", style=disnake.ButtonStyle.blurple, custom_id="start"
-                ),
-            ],
-        )
+    if not seen_interactions.first(inter.id):
+        return
+    custom_id = inter.data.custom_id
+    parsed = V.VoteRouter.parse(custom_id)
+    if custom_id in ("join", "start"):
+        kind = custom_id
+    else:
+        kind = parsed[0].lower() if parsed is not None else "button"
+
+    game = None
+    with loopwatch.profiler:
+        with metrics.registry.timed("interaction_seconds", kind=kind):
+            if custom_id == "join":
+                await join(inter)
+            elif custom_id == "start":
+                game = await start_game(inter)
+            else:
+                await route_vote(inter)
+        if game is not None:
+            # Playing the game out isn't part of handling the click
+            await game.run(game.play(inter))
+
+
+async def start_game(inter: disnake.MessageInteraction) -> "Game | None":
+    """Handles Start, returning the game if it is ready to be played"""
+    game = games.get(inter.message.id)
+    if game is None:
+        await inter.send("Could Not find game", ephemeral=True)
+        return None
+    try:
+        await inter.response.defer(with_message=False)
+        if await game.prepare(inter):
+            return game
+    except GameStartedError as e:
+        await inter.send(str(e), ephemeral=True)
+    return None
+
+
+async def join(inter: disnake.MessageInteraction) -> None:
+    game = games.get(inter.message.id)
+    if game is None:
+        await inter.send("Could Not find game", ephemeral=True)
+        return
+    if game.game_running:
+        await inter.send("Game has already started", ephemeral=True)
         return
+    if inter.user.id in game.players:
+        await inter.send("Already in game", ephemeral=True)
+        return
+    if len(game.players) >= MAX_PLAYERS:
+        await inter.send("Game is full", ephemeral=True)
+        return
+    game.touch()
+    game.add_player(inter.user)  # pyright: ignore[reportArgumentType]
+    await inter.send("Joined", ephemeral=True)
+    game.request_lobby_update()
 
-    if inter.data.custom_id == "start":
-        try:
-            await inter.response.defer(with_message=False)
-            await games[inter.message.id].start(inter)
-        except KeyError:
-            await inter.send("Could Not find game", ephemeral=True)
-        except GameStartedError as e:
-            await inter.send(str(e), ephemeral=True)
+
+@bot.listen("on_dropdown")
+async def handle_dropdown(inter: disnake.MessageInteraction):
+    if not seen_interactions.first(inter.id):
+        return
+    with metrics.registry.timed("interaction_seconds", kind="dropdown"), loopwatch.profiler:
+        await route_vote(inter)
+
+
+async def route_vote(inter: disnake.MessageInteraction) -> None:
+    """Hands a vote click to its vote, or to the other workers if it isn't open here"""
+    if await V.vote_router.dispatch(inter) or cluster is None:
         return
+    if V.VoteRouter.parse(inter.data.custom_id) is None:
+        return
+    guild_id = V.VoteRouter.guild(inter.data.custom_id)
+    if guild_id is not None and cluster.owns(guild_id):
+        # The game lives here so the vote has closed, like a stale click when running alone
+        return
+    # Answer within Discord's 3s while the owner is found
+    await inter.response.defer(with_message=False)
+    await cluster.forward(inter, guild_id)
+
+
+async def handle_forwarded(payload: C.Payload) -> None:
+    await V.vote_router.dispatch(C.ForwardedInteraction(payload, followup))  # pyright: ignore[reportArgumentType]
+
+
+async def followup(payload: C.Payload, content: str | None, ephemeral: bool) -> None:
+    """Replies to an interaction another worker deferred"""
+    await bot.http.request(
+        Route(
+            "POST",
+            "/webhooks/{application_id}/{interaction_token}",
+            application_id=payload["application_id"],
+            interaction_token=payload["token"],
+        ),
+        json={"content": content, "flags": 64 if ephemeral else 0},
+    )
+
+
+@bot.slash_command(description="Shows what the bot is doing and how fast")
+async def stats(inter: disnake.ApplicationCommandInteraction):
+    guild_id = inter.guild_id
+    guild = [game for game in games.values() if game.id == guild_id]
+    embed = disnake.Embed(title="Stats", colour=disnake.Colour.blurple())
+
+    embed.add_field(
+        name="This server",
+        value=(
+            f"{sum(game.game_running for game in guild)} games, "
+            f"{sum(not game.game_running for game in guild)} lobbies, "
+            f"{sum(len(game.sessions) for game in guild)} open votes\n"
+            f"{metrics.registry.total('api_calls', guild=guild_id)} requests, "
+            f"{metrics.registry.total('api_errors', guild=guild_id)} failed"
+        ),
+        inline=False,
+    )
+    for game in guild:
+        if game.game_running:
+            embed.add_field(
+                name=f"Game {game.start_message_id}",
+                value=f"{game.phase}, {game.api_calls.total()} requests, "
+                f"{game.api_calls['errors']} failed",
+            )
+
+    embed.add_field(
+        name="Everywhere",
+        value=", ".join(f"{value} {name.replace('_', ' ')}" for name, value in gauges().items()),
+        inline=False,
+    )
+    timings = [
+        f"{name.removesuffix('_seconds')} {' '.join(value for _, value in labels)}: "
+        f"p50 {histogram.format_quantile(0.5)}, p99 {histogram.format_quantile(0.99)} "
+        f"(n={histogram.count})"
+        for (name, labels), histogram in sorted(metrics.registry.histograms.items())
+        if histogram.count
+    ]
+    if timings:
+        embed.add_field(name="Timings", value="\n".join(timings), inline=False)
+    stalls = [
+        f"<t:{int(stall.at)}:R> {stall.seconds * 1000:.0f}ms in {stall.coroutine}"
+        for stall in list(loopwatch.watchdog.stalls)[-5:]
+    ]
+    if stalls:
+        embed.add_field(name="Event loop stalls", value="\n".join(stalls), inline=False)
+    await inter.send(embed=embed, ephemeral=True)
+
+
+def add_game(game: Game) -> None:
+    games[game.start_message_id] = game
+    guild_games[game.id] += 1
+    game.touch()
+    game.expiry = timers.timer_wheel.schedule(LOBBY_TTL, game.check_idle)
 
 
 def stop_game(game: Game):
+    if games.get(game.start_message_id) is not game:
+        return
     games.pop(game.start_message_id)
+    guild_games[game.id] -= 1
+    if not guild_games[game.id]:
+        del guild_games[game.id]
+    if game.expiry is not None:
+        game.expiry.cancel()
+
+
+def evict(game: Game) -> None:
+    """Closes an idle or stuck game along with its open votes"""
+    for session in list(game.sessions):
+        session.cancel()
+    for player in game.players.values():
+        if player.dm_check is not None:
+            player.dm_check.cancel()
+    game.lobby_updates.cancel()
+    if not game.game_running:
+        game.closing = asyncio.create_task(game.close_lobby())
+    if game.task is not None and not game.task.done():
+        game.task.cancel()
+    stop_game(game)
+    store.delete_snapshot(game.start_message_id)
+
+
+def restore_game(snapshot: S.Snapshot, votes: list[S.Snapshot]) -> Game | None:
+    """Rebuilds a game saved before a restart
+    Returns:
+        Game: the game, or None if its channel is gone"""
+    channel = bot.get_channel(snapshot["channel_id"])
+    if not isinstance(channel, disnake.TextChannel):
+        store.delete_snapshot(snapshot["start_message_id"])
+        return None
 
+    game = Game(channel, channel.get_partial_message(snapshot["start_message_id"]))
+    for player_id, name, *_ in snapshot["players"]:
+        game.players[player_id] = Player(player_id, name, game.transport)
+    game.restore(snapshot, votes)
+    add_game(game)
+    return game
 
 
+METRICS_PORT: int | None = None
+"""Local port to serve Prometheus metrics on, None to not serve them.
+Worker n of a cluster serves on METRICS_PORT + n"""
+
+PROFILE_PATH: str | None = None
+"""File to write flamegraph samples of games, votes and interactions to, None to not profile.
+Worker n of a cluster writes to the path with .n before its extension"""
+
+resumed = False
+
+
+@bot.listen("on_ready")
+async def resume_games():
+    """Picks up the games that were running when the bot last stopped"""
+    global resumed
+    if resumed:
+        # on_ready fires again after every reconnect
+        return
+    resumed = True
+    loopwatch.watchdog.start()
+    if cluster is not None:
+        await cluster.listen(handle_forwarded)
+    if PROFILE_PATH is not None:
+        loopwatch.profiler.start(PROFILE_PATH if cluster is None else cluster.path(PROFILE_PATH))
+    for snapshot, votes in await asyncio.to_thread(store.load_snapshots):
+        if cluster is not None and not cluster.owns(snapshot["guild_id"]):
+            # Another worker's game
+            continue
+        game = restore_game(snapshot, votes)
+        if game is not None:
+            game.task = asyncio.create_task(game.resume())
+    if METRICS_PORT is not None:
+        # Last, a port that is taken leaves the games running without metrics
+        await metrics.serve(METRICS_PORT if cluster is None else cluster.port(METRICS_PORT))
+
+
+def gauges() -> dict[str, int]:
+    """Counts of what is currently held in memory"""
+    return {
+        "games": sum(game.game_running for game in games.values()),
+        "lobbies": sum(not game.game_running for game in games.values()),
+        "players": sum(len(game.players) for game in games.values()),
+        "votes": sum(len(game.sessions) for game in games.values()),
+        "pending_voters": len(V.vote_router.sessions),
+        "queued_requests": discord_transport.scheduler.queued(),
+    }
+
+
+metrics.registry.gauges.append(gauges)
+
 if __name__ == "__main__":
     with open("token.txt", "r") as f:
         token = f.read()
-    bot.run(token)
\ No newline at end of file
+    bot.run(token)
+    loopwatch.profiler.stop()
+    store.close()
+    if event_log is not None:
+        event_log.close()
\ No newline at end of file
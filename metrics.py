@@ -0,0 +1,167 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Callable
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+"""Upper bounds in seconds of the latency histogram buckets"""
+
+PREFIX = "werewolf_"
+
+AGGREGATED = ("guild",)
+"""Labels counted per value for /stats but summed away in the metrics endpoint,
+one series per guild would grow without bound"""
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        """Observations per bucket, the last one is everything over BUCKETS[-1]"""
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the q quantile falls in, clamped to the
+        last bound when it is past all of them"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+    def format_quantile(self, q: float) -> str:
+        """The q quantile for display, ">600s" when it is past the last bucket"""
+        if self.count - self.counts[-1] < q * self.count:
+            return f">{BUCKETS[-1]}s"
+        return f"{self.quantile(q)}s"
+
+
+class Timed:
+    """Times a with block into a histogram"""
+
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Registry:
+    """Latency histograms and counters, kept in memory and rendered on demand.
+
+    Recording is a dict lookup and a few additions, nothing is formatted or
+    sent until /stats or the metrics endpoint asks for it."""
+
+    def __init__(self) -> None:
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.counters: Counter[tuple[str, Labels]] = Counter()
+        self.gauges: list[Callable[[], dict[str, int]]] = []
+        """Called on every render for values that are read rather than counted"""
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def timed(self, name: str, **labels: str) -> Timed:
+        return Timed(self.histogram(name, **labels))
+
+    def count(self, name: str, n=1, **labels) -> None:
+        self.counters[(name, tuple(labels.items()))] += n
+
+    def total(self, name: str, **labels) -> int:
+        """Sums a counter over every label set that includes labels"""
+        wanted = {(key, str(value)) for key, value in labels.items()}
+        return sum(
+            count
+            for (counter, counter_labels), count in self.counters.items()
+            if counter == name and wanted <= {(k, str(v)) for k, v in counter_labels}
+        )
+
+    def render(self) -> str:
+        """Formats everything in the Prometheus text exposition format"""
+        lines = []
+        for source in self.gauges:
+            for name, value in source().items():
+                lines.append(f"# TYPE {PREFIX}{name} gauge")
+                lines.append(f"{PREFIX}{name} {value}")
+
+        counters: Counter[tuple[str, Labels]] = Counter()
+        for (name, labels), count in self.counters.items():
+            kept = tuple((key, value) for key, value in labels if key not in AGGREGATED)
+            counters[(name, kept)] += count
+
+        typed = set()
+        for (name, labels), count in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            lines.append(f"{PREFIX}{name}_total{format_labels(labels)} {count}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+            seen = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                seen += count
+                lines.append(
+                    f"{PREFIX}{name}_bucket{format_labels(labels + (('le', str(bound)),))} {seen}"
+                )
+            lines.append(
+                f"{PREFIX}{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}"
+            )
+            lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = Registry()
+
+
+async def serve(port: int, host="127.0.0.1") -> asyncio.Server:
+    """Serves registry.render() over HTTP for a Prometheus scraper"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import pstats
+import sys
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+import disnake
+
+import events as E
+import main as M
+import simulation as Sim
+import votes as V
+
+
+class ReplayTransport(Sim.FakeTransport):
+    """Answers each vote with the confirms a logged game made in it, and lets
+    a vote that timed out in the log expire as soon as those are in"""
+
+    def __init__(self, events: list[E.Event]) -> None:
+        super().__init__(None)
+        self.closes: defaultdict[str, deque[E.Event]] = defaultdict(deque)
+        """Vote id: its closings in the order they happened"""
+        for event in events:
+            if event["event"] == "vote":
+                self.closes[event["vote"]].append(event)
+        self.logged: dict[V.VoteSession, tuple[dict[int, int], bool]] = {}
+        """Session: its logged confirms and whether it timed out"""
+        self.exhausted = asyncio.Event()
+        """Set when the game opens a vote the log ends before"""
+
+    def session_log(self, session: V.VoteSession) -> tuple[dict[int, int], bool] | None:
+        if session not in self.logged:
+            closes = self.closes[session.vote_id]
+            if not closes:
+                self.exhausted.set()
+                return None
+            close = closes.popleft()
+            self.logged[session] = (dict(close["confirmed"]), close["timed_out"])
+            self.check_expired(session)
+        return self.logged[session]
+
+    def check_expired(self, session: V.VoteSession) -> None:
+        confirmed, timed_out = self.logged[session]
+        if timed_out and len(session.confirmed) >= len(confirmed):
+            session.expire()
+
+    def answer_vote(self, fields, voters: list["M.Player"], dm: bool) -> None:
+        components = fields.get("components") or []
+        selects = [c for c in components if isinstance(c, disnake.ui.StringSelect)]
+        confirm = next((c for c in components if isinstance(c, disnake.ui.Button)), None)
+        if not selects or confirm is None:
+            return
+        parsed = V.VoteRouter.parse(selects[0].custom_id)
+        session = None if parsed is None else V.vote_router.sessions.get(parsed[1])
+        if session is None:
+            return
+        logged = self.session_log(session)
+        if logged is None:
+            return
+        for player in voters:
+            if player.id in logged[0]:
+                task = asyncio.create_task(
+                    self.replay(session, player, logged[0][player.id], selects, confirm, dm)
+                )
+                self.answering.add(task)
+                task.add_done_callback(self.answering.discard)
+
+    async def replay(
+        self,
+        session: V.VoteSession,
+        player: "M.Player",
+        target: int,
+        selects: list[disnake.ui.StringSelect],
+        confirm: disnake.ui.Button,
+        dm: bool,
+    ) -> None:
+        select = Sim.select_with(selects, str(target))
+        await self.click(Sim.FakeInteraction(self, select.custom_id, [str(target)], player.id), dm)
+        await self.click(Sim.FakeInteraction(self, str(confirm.custom_id), None, player.id), dm)
+        self.check_expired(session)
+
+
+def outcome(events: list[E.Event]) -> list[tuple]:
+    """The parts of a game a replay has to reproduce exactly. A phase's votes
+    close in whatever order their voters finish, so they are compared as a set.
+    They all close before the phase's deaths, and a resumed game logs the phase
+    it resumes in again, so the set is closed at either"""
+    kept: list[tuple] = []
+    closed: list[tuple] = []
+    for event in events:
+        if event["event"] in ("phase", "death", "end"):
+            kept.extend(sorted(closed))
+            closed = []
+        if event["event"] == "roles":
+            kept.append(("roles", tuple(map(tuple, event["roles"]))))
+        elif event["event"] == "vote":
+            closed.append(("vote", event["vote"], event["result"] or 0))
+        elif event["event"] == "death":
+            kept.append(("death", event["player"], event["reason"]))
+        elif event["event"] == "end":
+            kept.append(("end", event["winner"]))
+    return kept + sorted(closed)
+
+
+async def replay(game_id: int, events: list[E.Event]) -> tuple[bool, str]:
+    """Plays a logged game again from its seed and logged votes
+    Returns:
+        tuple: whether it played out the same way, and a line describing it"""
+    start = next((event for event in events if event["event"] == "start"), None)
+    if start is None:
+        return False, f"{game_id}: no start event, the log begins mid-game"
+
+    M.store.save(start["guild"], start["config"])
+    transport = ReplayTransport(events)
+    channel = SimpleNamespace(id=start["guild"], guild=SimpleNamespace(id=start["guild"]))
+    game = M.Game(channel, SimpleNamespace(id=game_id), transport, start["seed"])  # pyright: ignore[reportArgumentType]
+    game.start_delay = 0
+    for player_id, name in start["players"]:
+        game.players[player_id] = M.Player(player_id, name, game.transport)
+    M.add_game(game)
+
+    task = asyncio.create_task(game.start(Sim.FakeInteraction(transport, "start")))  # pyright: ignore[reportArgumentType]
+    exhausted = asyncio.create_task(transport.exhausted.wait())
+    await asyncio.wait([task, exhausted], return_when=asyncio.FIRST_COMPLETED)
+    exhausted.cancel()
+    if not task.done():
+        M.evict(game)
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    else:
+        task.result()
+
+    assert isinstance(M.event_log, E.EventLog)
+    replayed = [event for event in M.event_log.events if event["game"] == game_id]
+    expected, got = outcome(events), outcome(replayed)
+    resumed = any(event["event"] == "resume" for event in events)
+    description = (
+        f"{game_id}: {len(start['players'])} players, {len(got)} outcomes, "
+        f"winner {game.winning_team or 'none'}"
+        + (", resumed after a restart" if resumed else "")
+        + (", log ends mid-game" if transport.exhausted.is_set() else "")
+    )
+    if got == expected:
+        return True, description + ", matches"
+    diverged = next(
+        (i for i, (a, b) in enumerate(zip(expected, got)) if a != b), min(len(expected), len(got))
+    )
+    logged = expected[diverged] if diverged < len(expected) else "end of log"
+    played = got[diverged] if diverged < len(got) else "end of replay"
+    return False, description + f", diverges at {diverged}: logged {logged}, replayed {played}"
+
+
+async def replay_all(games: dict[int, list[E.Event]], repeat: int) -> int:
+    Sim.use_memory_store()
+    M.event_log = E.EventLog(None, max_events=None)
+    failures = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for game_id, events in games.items():
+            matched, description = await replay(game_id, events)
+            failures += not matched
+            print(description)
+        M.event_log.events.clear()
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {len(games) * repeat} games in {elapsed:.2f}s, {failures} diverged")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replays games from an event log against the game logic, offline"
+    )
+    parser.add_argument("log", nargs="?", default="events.jsonl")
+    parser.add_argument("--game", type=int, nargs="+", help="start message ids to replay")
+    parser.add_argument("--repeat", type=int, default=1, help="replay every game this many times")
+    parser.add_argument("--profile", action="store_true", help="print the hottest functions")
+    args = parser.parse_args()
+
+    games = E.by_game(E.read(args.log))
+    if args.game:
+        games = {game_id: games[game_id] for game_id in args.game if game_id in games}
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        failures = profiler.runcall(asyncio.run, replay_all(games, args.repeat))
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    else:
+        failures = asyncio.run(replay_all(games, args.repeat))
+    sys.exit(1 if failures else 0)
@@ -1,4 +1,4 @@
-from abc import ABC, abstractmethod
+from enum import Enum, IntEnum
 import disnake
 from typing import TYPE_CHECKING
 
@@ -6,7 +6,10 @@ if TYPE_CHECKING:
     from main import Player, Game
 
 
-ROLE_REGISTRY: dict[str, "Role"] = {}
+ROLE_REGISTRY: dict[str, type["Role"]] = {}
+
+ROLE_CARDS: dict[str, disnake.Embed] = {}
+"""Role name: the card its players are sent when roles are handed out"""
 
 
 def register_role(cls):
@@ -14,25 +17,88 @@ def register_role(cls):
     return cls
 
 
-class Role(ABC):
-    def __init__(self, name: str, team: str, colour: disnake.Colour) -> None:
-        self.done = False
-        self.name = name
-        self.team = team
-        self.colour = colour
-        self.config = {"chance": 50, "count": 1}
+class Action(IntEnum):
+    """What a night action does to its target, resolved in this order"""
+
+    PROTECT = 0
+    KILL = 1
+    INSPECT = 2
+
+
+class Targets(Enum):
+    OTHERS = "others"
+    """Alive players other than the one acting"""
+    ANYONE = "anyone"
+    """Every other player, dead or alive"""
+    ENEMIES = "enemies"
+    """Alive players outside the acting player's team"""
+
+
+class NightAction:
+    """A choice a role makes every night, collected by Game.night_phase in the
+    single vote each player gets and applied in Action order
 
-    @abstractmethod
-    async def night_action(self, player: "Player", game: "Game") -> None:
-        pass
+    Args:
+        action: what happens to the chosen player
+        prompt: title of the vote
+        targets: who can be chosen
+        shared: vote id of a vote shared by every alive player with this
+            action, like the wolves' kill, None for a vote of their own
+        report: sent to the voters once resolved, formatted with the
+            chosen player's name and role"""
+
+    __slots__ = ("action", "prompt", "targets", "shared", "report")
+
+    def __init__(
+        self,
+        action: Action,
+        prompt: str,
+        targets: Targets,
+        shared: str | None = None,
+        report: str | None = None,
+    ) -> None:
+        self.action = action
+        self.prompt = prompt
+        self.targets = targets
+        self.shared = shared
+        self.report = report
+
+    def options(self, player: "Player", game: "Game") -> list["Player"]:
+        if self.targets is Targets.ANYONE:
+            return [p for p in game.players.values() if p is not player]
+        if self.targets is Targets.ENEMIES:
+            return [p for p in game.alive.values() if p.role.team != player.role.team]
+        return [p for p in game.alive.values() if p is not player]
+
+
+class Role:
+    """Roles hold no per game state, their metadata is shared by the class so
+    every player's role instance is an empty slotted object"""
+
+    __slots__ = ()
+
+    name: str
+    team: str
+    colour: disnake.Colour
+    config: dict[str, int] = {"chance": 50, "count": 1}
+    """Defaults for new guild configs, copy before changing"""
+    night_action: NightAction | None = None
+    sleep_message: str | None = None
+    """Sent at nightfall to players of a role without a night action"""
 
     async def assign_action(self, player: "Player", game: "Game") -> None:
-        embed = disnake.Embed(
-            title=f"You are a {self.name}",
-            description="Game start in 5s",
-            color=self.colour,
-        )
-        await player.member.send(embed=embed)
+        await player.send(embed=self.card())
+
+    def card(self) -> disnake.Embed:
+        """Built once per role and shared by every game"""
+        embed = ROLE_CARDS.get(self.name)
+        if embed is None:
+            embed = ROLE_CARDS[self.name] = disnake.Embed(
+                title=f"You are a {self.name}",
+                description="Game start in 5s",
+                color=self.colour,
+            )
+        return embed
 
     def __str__(self) -> str:
         return self.name
@@ -40,80 +106,63 @@ class Role(ABC):
 
 @register_role
 class Villager(Role):
-    def __init__(self) -> None:
-        super().__init__("Villager", "Village", disnake.Colour.yellow())
-        self.config = {"chance": 0, "count": 1, "can_skip_vote": 1, "dead_see_roles": 1}
-
-    async def night_action(
-        self,
-        player: "Player",
-        game: "Game",
-    ) -> None:
-        await player.send("You sleep peacefully through the night...")
+    __slots__ = ()
+    name = "Villager"
+    team = "Villagers"
+    colour = disnake.Colour.yellow()
+    config = {
+        "chance": 0,
+        "count": 1,
+        "can_skip_vote": 1,
+        "dead_see_roles": 1,
+        "night_seconds": 120,
+        "day_seconds": 300,
+        "broadcast": 0,
+    }
+    sleep_message = "You sleep peacefully through the night..."
 
 
 @register_role
 class Seer(Role):
-    def __init__(self):
-        self.target: Player | None = None
-        super().__init__("Seer", "Villagers", disnake.Colour.purple())
-
-    async def night_action(self, player: "Player", game: "Game") -> None:
-        targets = [p for p in game.players.values()]
-        targets.remove(player)
-        to_see = await game.vote(
-            "Choose a player to see",
-            disnake.Colour.purple(),
-            str(player.id),
-            [player],
-            targets,
-            False,
-        )
-        if to_see:
-            await player.send(f"{to_see.name} is a {to_see.role.name}")
+    __slots__ = ()
+    name = "Seer"
+    team = "Villagers"
+    colour = disnake.Colour.purple()
+    night_action = NightAction(
+        Action.INSPECT, "Choose a player to see", Targets.ANYONE, report="{name} is a {role}"
+    )
 
 
 @register_role
 class Medic(Role):
-    def __init__(self):
-        super().__init__("Medic", "Villagers", disnake.Colour.green())
-
-    async def night_action(self, player: "Player", game: "Game") -> None:
-        targets = [p for p in game.players.values() if p.is_alive]
-        targets.remove(player)
-        to_protect = await game.vote(
-            "Choose a player to protect",
-            disnake.Colour.green(),
-            str(player.id),
-            [player],
-            targets,
-            False,
-        )
-        if to_protect:
-            game.safe_players.append(to_protect)
-            await player.send(f"You protected {to_protect.name} from the wolves")
-        pass
+    __slots__ = ()
+    name = "Medic"
+    team = "Villagers"
+    colour = disnake.Colour.green()
+    night_action = NightAction(
+        Action.PROTECT,
+        "Choose a player to protect",
+        Targets.OTHERS,
+        report="You protected {name} from the wolves",
+    )
 
 
 @register_role
 class Werewolf(Role):
-    def __init__(self):
-        super().__init__("Werewolf", "Wolves", disnake.Colour.red())
-        self.config = {"chance": 100, "count": 1, "can_skip_vote": 1}
-
-    async def night_action(self, player: "Player", game: "Game") -> None:
-        pass
+    __slots__ = ()
+    name = "Werewolf"
+    team = "Wolves"
+    colour = disnake.Colour.red()
+    config = {"chance": 100, "count": 1, "can_skip_vote": 1}
+    night_action = NightAction(
+        Action.KILL, "Chose a player to kill", Targets.ENEMIES, shared="wolf"
+    )
 
     async def assign_action(self, player: "Player", game: "Game") -> None:
-        wolves = [p.name for p in game.players.values() if p.role.team == "Wolves"]
+        wolves = [p.name for p in game.alive_teams["Wolves"].values()]
 
         if len(wolves) == 1:
-            embed = disnake.Embed(
-                title=f"You are a {self.name}",
-                description="Game start in 5s",
-                color=disnake.Colour.red(),
-            )
-            await player.member.send(embed=embed)
+            await player.send(embed=self.card())
         else:
             embed = disnake.Embed(
                 title=f"There are {len(wolves)} wolves, you are one of them",
@@ -122,4 +171,4 @@ class Werewolf(Role):
             )
             for wolf in wolves:
                 embed.add_field(name="Inline Title", value=wolf, inline=True)
-            await player.member.send(embed=embed)
\ No newline at end of file
+            await player.send(embed=embed)
\ No newline at end of file
@@ -0,0 +1,205 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+GLOBAL_LIMIT = 50
+"""Requests per second Discord allows a bot across all routes"""
+
+ROUTE_LIMIT = 5
+ROUTE_WINDOW = 5.0
+"""Requests allowed per route (a DM channel) within ROUTE_WINDOW seconds"""
+
+CONCURRENCY = 20
+"""Max requests in flight at once"""
+
+
+class Bucket:
+    """Sliding window budget of one route and the requests queued on it"""
+
+    def __init__(self, limit: int, window: float) -> None:
+        self.limit = limit
+        self.window = window
+        self.sent: deque[float] = deque()
+        self.queue: list[tuple[int, int, "Job"]] = []
+        self.scheduled = False
+        """Whether the bucket is already waiting in the ready heap or on a timer"""
+
+    def available_at(self, now: float) -> float:
+        while self.sent and self.sent[0] <= now - self.window:
+            self.sent.popleft()
+        if len(self.sent) < self.limit:
+            return now
+        return self.sent[0] + self.window
+
+
+class Job:
+    def __init__(
+        self,
+        priority: int,
+        call: Callable[..., Awaitable[Any]],
+        fields: dict[str, Any],
+        edit_key: Hashable | None,
+    ) -> None:
+        self.priority = priority
+        self.call = call
+        self.fields = fields
+        self.edit_key = edit_key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class Scheduler:
+    """Queues outbound requests per route and sends them within Discord's limits.
+
+    Lower priorities go first, each route only spends its own budget so a
+    busy DM channel can't hold up the others, and an edit queued for a
+    message that already has an edit waiting is merged into it instead of
+    being sent twice. An edit for a message with an edit in flight is held
+    until that one is done, so edits to a message land in order."""
+
+    def __init__(
+        self,
+        global_limit=GLOBAL_LIMIT,
+        route_limit=ROUTE_LIMIT,
+        route_window=ROUTE_WINDOW,
+        concurrency=CONCURRENCY,
+    ) -> None:
+        self.route_limit = route_limit
+        self.route_window = route_window
+        self.concurrency = concurrency
+        self.global_bucket = Bucket(global_limit, 1.0)
+        self.buckets: dict[Hashable, Bucket] = {}
+        self.ready: list[tuple[int, int, Hashable]] = []
+        self.pending_edits: dict[Hashable, Job] = {}
+        self.sending_edits: set[Hashable] = set()
+        self.held_edits: dict[Hashable, tuple[Hashable, Job]] = {}
+        """Edit key: route and edit waiting for the previous edit of its message"""
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.worker: asyncio.Task | None = None
+        self.in_flight: set[asyncio.Task] = set()
+        self.superseded = 0
+
+    def queued(self) -> int:
+        return len(self.held_edits) + sum(len(bucket.queue) for bucket in self.buckets.values())
+
+    async def submit(
+        self,
+        route: Hashable,
+        priority: int,
+        call: Callable[..., Awaitable[Any]],
+        edit_key: Hashable | None = None,
+        **fields,
+    ) -> Any:
+        """Queues call(**fields) on a route and returns its result once sent
+        Args:
+            route: the rate limit bucket the request counts against
+            priority: lower is sent first
+            call: the request to make
+            edit_key: the message an edit is for, later edits replace it while queued
+        """
+        if edit_key is not None and edit_key in self.pending_edits:
+            job = self.pending_edits[edit_key]
+            job.fields.update(fields)
+            self.superseded += 1
+            # Sent edits can't be reordered, only merged while still queued
+            return await asyncio.shield(job.future)
+
+        job = Job(priority, call, fields, edit_key)
+        if edit_key is not None:
+            self.pending_edits[edit_key] = job
+            if edit_key in self.sending_edits:
+                self.held_edits[edit_key] = (route, job)
+                return await job.future
+        self.enqueue(route, job)
+        return await job.future
+
+    def enqueue(self, route: Hashable, job: Job) -> None:
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            bucket = self.buckets[route] = Bucket(self.route_limit, self.route_window)
+        heapq.heappush(bucket.queue, (job.priority, next(self.seq), job))
+        self.schedule(route, bucket)
+
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+    def schedule(self, route: Hashable, bucket: Bucket) -> None:
+        if bucket.scheduled or not bucket.queue:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        at = bucket.available_at(now)
+        bucket.scheduled = True
+        if at <= now:
+            priority, seq, _ = bucket.queue[0]
+            heapq.heappush(self.ready, (priority, seq, route))
+            self.wakeup.set()
+        else:
+            loop.call_at(at, self.refilled, route, bucket)
+
+    def refilled(self, route: Hashable, bucket: Bucket) -> None:
+        bucket.scheduled = False
+        self.schedule(route, bucket)
+
+    def forget(self, route: Hashable) -> None:
+        """Drops an idle bucket once its window has passed"""
+        bucket = self.buckets.get(route)
+        if bucket is None or bucket.queue or bucket.scheduled:
+            return
+        bucket.available_at(asyncio.get_running_loop().time())
+        if not bucket.sent:
+            del self.buckets[route]
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            if not self.ready:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            at = self.global_bucket.available_at(loop.time())
+            if at > loop.time():
+                await asyncio.sleep(at - loop.time())
+                continue
+            await semaphore.acquire()
+
+            _, _, route = heapq.heappop(self.ready)
+            bucket = self.buckets[route]
+            bucket.scheduled = False
+            _, _, job = heapq.heappop(bucket.queue)
+            now = loop.time()
+            bucket.sent.append(now)
+            self.global_bucket.sent.append(now)
+            if job.edit_key is not None:
+                del self.pending_edits[job.edit_key]
+                self.sending_edits.add(job.edit_key)
+
+            task = asyncio.create_task(self.execute(job, semaphore))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+            if bucket.queue:
+                self.schedule(route, bucket)
+            else:
+                loop.call_later(bucket.window, self.forget, route)
+
+    async def execute(self, job: Job, semaphore: asyncio.Semaphore) -> None:
+        try:
+            result = await job.call(**job.fields)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            semaphore.release()
+            if job.edit_key is not None:
+                self.sending_edits.discard(job.edit_key)
+                held = self.held_edits.pop(job.edit_key, None)
+                if held is not None:
+                    self.enqueue(*held)
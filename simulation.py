@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from typing import Any, Callable
+
+import disnake
+
+import events as E
+import main as M
+import storage as S
+import transport as T
+import votes as V
+
+Voter = Callable[["M.Player", list[str]], str]
+"""Picks one of the option values of a vote for a bot player"""
+
+
+def random_voter(rng: random.Random) -> Voter:
+    def vote(player: "M.Player", options: list[str]) -> str:
+        return rng.choice(options)
+
+    return vote
+
+
+class FakeMessage:
+    def __init__(self, id: int, channel_id: int, content: str | None, fields) -> None:
+        self.id = id
+        self.channel_id = channel_id
+        """The channel posted in, or the player's id for DMs"""
+        self.content = content
+        self.fields = fields
+
+
+interaction_ids = itertools.count(1)
+
+
+class FakeInteraction:
+    """Just enough of a disnake.MessageInteraction for the vote handlers"""
+
+    def __init__(
+        self,
+        transport: "FakeTransport",
+        custom_id: str,
+        values: list[str] | None = None,
+        author_id=0,
+    ) -> None:
+        self.transport = transport
+        self.id = next(interaction_ids)
+        self.application_id = 0
+        self.token = ""
+        self.author = SimpleNamespace(id=author_id)
+        self.data = SimpleNamespace(custom_id=custom_id, values=values)
+        self.response = SimpleNamespace(defer=self.defer)
+
+    async def defer(self, **kwargs) -> None:
+        self.transport.calls["defer"] += 1
+
+    async def send(self, content: str | None = None, **fields) -> None:
+        self.transport.calls["respond"] += 1
+
+
+class FakeTransport(T.Transport):
+    """Answers every vote DM with a bot voter instead of sending it to Discord
+
+    Messages Discord would reject, like a select with no options or more
+    than it allows, raise instead of being sent.
+
+    Args:
+        voter: picks the choice for each bot player, or None to leave votes open
+        latency: seconds each outbound call takes
+        record: keep every sent message in inbox"""
+
+    unreachable: set[int]
+    """Players whose DMs fail with a server error instead of being sent"""
+
+    def __init__(self, voter: Voter | None, latency=0.0, record=False) -> None:
+        self.voter = voter
+        self.latency = latency
+        self.record = record
+        self.calls: Counter[str] = Counter()
+        self.inbox: dict[int, list[FakeMessage]] = defaultdict(list)
+        self.message_ids = itertools.count(1)
+        self.answering: set[asyncio.Task] = set()
+        self.unreachable = set()
+
+    def validate(self, content: str | None, fields) -> None:
+        if content is not None and len(content) > V.MAX_CONTENT:
+            raise ValueError(f"A message can't have {len(content)} characters")
+        components = fields.get("components") or []
+        selects = [c for c in components if isinstance(c, disnake.ui.StringSelect)]
+        for select in selects:
+            if not 1 <= len(select.options) <= V.MAX_OPTIONS:
+                raise ValueError(f"A select can't have {len(select.options)} options")
+        if len(selects) > V.MAX_SELECTS:
+            raise ValueError(f"A vote can't have {len(selects)} selects")
+        embed = fields.get("embed")
+        if embed is not None and len(embed.fields) > V.MAX_FIELDS:
+            raise ValueError(f"An embed can't have {len(embed.fields)} fields")
+
+    async def deliver(self, kind: str, channel_id: int, content: str | None, fields) -> FakeMessage:
+        self.validate(content, fields)
+        self.calls[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = FakeMessage(next(self.message_ids), channel_id, content, fields)
+        if self.record:
+            self.inbox[channel_id].append(message)
+        return message
+
+    async def send(
+        self,
+        player: "M.Player",
+        content: str | None = None,
+        priority=T.Priority.NOTICE,
+        **fields,
+    ) -> Any:
+        if player.id in self.unreachable:
+            self.calls["failed_send"] += 1
+            response: Any = SimpleNamespace(status=500, reason="Internal Server Error")
+            raise disnake.HTTPException(response, "DM failed")
+        message = await self.deliver("send", player.id, content, fields)
+        self.answer_vote(fields, [player], dm=True)
+        return message
+
+    async def post(
+        self, channel: Any, content: str | None = None, priority=T.Priority.NOTICE, **fields
+    ) -> Any:
+        message = await self.deliver("post", channel.id, content, fields)
+        components = fields.get("components") or []
+        for component in components:
+            parsed = V.VoteRouter.parse(str(component.custom_id))
+            if parsed is not None and parsed[1] in V.vote_router.sessions:
+                # A shared vote, every voter answers on the one message
+                self.answer_vote(fields, V.vote_router.sessions[parsed[1]].voters, dm=False)
+                break
+        return message
+
+    async def create_thread(self, channel: Any, name: str) -> Any:
+        self.calls["thread"] += 1
+        return SimpleNamespace(id=next(self.message_ids), guild=channel.guild)
+
+    async def edit(self, message: Any, priority=T.Priority.COSMETIC, **fields) -> None:
+        self.validate(fields.get("content"), fields)
+        self.calls["edit"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message.fields.update(fields)
+
+    def channel(self, message: Any) -> int:
+        return message.channel_id
+
+    def messageable(self, channel_id: Any) -> Any:
+        return SimpleNamespace(id=channel_id)
+
+    def message(self, channel_id: Any, message_id: int) -> Any:
+        return FakeMessage(message_id, channel_id, None, {})
+
+    def answer_vote(self, fields, voters: list["M.Player"], dm: bool) -> None:
+        """Has the bot voters answer a vote if the message has one"""
+        components = fields.get("components") or []
+        selects = [c for c in components if isinstance(c, disnake.ui.StringSelect)]
+        confirm = next((c for c in components if isinstance(c, disnake.ui.Button)), None)
+        if self.voter is None or not selects or confirm is None:
+            return
+        for player in voters:
+            task = asyncio.create_task(self.answer(player, selects, confirm, dm))
+            self.answering.add(task)
+            task.add_done_callback(self.answering.discard)
+
+    async def answer(
+        self,
+        player: "M.Player",
+        selects: list[disnake.ui.StringSelect],
+        confirm: disnake.ui.Button,
+        dm: bool,
+    ) -> None:
+        assert self.voter is not None
+        choice = self.voter(player, [o.value for select in selects for o in select.options])
+        await self.click(
+            FakeInteraction(self, select_with(selects, choice).custom_id, [choice], player.id), dm
+        )
+        await self.click(FakeInteraction(self, str(confirm.custom_id), None, player.id), dm)
+
+    async def click(self, inter: FakeInteraction, dm: bool) -> None:
+        """Delivers a bot player's click, dm: whether it was on a DMed vote"""
+        await V.vote_router.dispatch(inter)  # pyright: ignore[reportArgumentType]
+
+
+def select_with(selects: list[disnake.ui.StringSelect], value: str) -> disnake.ui.StringSelect:
+    """The select of a vote that has an option"""
+    return next(s for s in selects if any(o.value == value for o in s.options))
+
+
+class SimulatedGame(M.Game):
+    """A game that records how long each of its phases took and, when it has a
+    fake transport to itself, how many API calls each phase made"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        fake = self.transport
+        while not isinstance(fake, FakeTransport):
+            fake = fake.inner  # pyright: ignore[reportAttributeAccessIssue]
+        self.fake: FakeTransport = fake
+        self.phase_times: dict[str, list[float]] = defaultdict(list)
+        self.phase_calls: dict[str, list[int]] = defaultdict(list)
+        self.restart = False
+        """Stop the game once its first day vote closes, like the bot shutting down"""
+
+    async def timed(self, phase: str, coro) -> None:
+        calls = self.fake.calls.total()
+        started = time.perf_counter()
+        await coro
+        self.phase_times[phase].append(time.perf_counter() - started)
+        self.phase_calls[phase].append(self.fake.calls.total() - calls)
+
+    async def assign_roles(self) -> None:
+        await self.timed("assign_roles", super().assign_roles())
+
+    async def night_phase(self) -> None:
+        await self.timed("night_phase", super().night_phase())
+
+    async def day_phase(self) -> None:
+        await self.timed("day_phase", super().day_phase())
+
+    async def vote(self, title, colour, vote_id, *args, **kwargs) -> "M.Player | None":
+        result = await super().vote(title, colour, vote_id, *args, **kwargs)
+        if self.restart and vote_id == "vote":
+            # Between the vote closing and the kill it decides, the snapshot is kept
+            self.restart = False
+            task = asyncio.current_task()
+            assert task is not None
+            task.cancel()
+            await asyncio.sleep(0)
+        return result
+
+
+start_message_ids = itertools.count(1)
+
+
+def create_game(
+    transport: T.Transport, players: int, guild_id=1, seed: int | None = None
+) -> SimulatedGame:
+    """Creates a lobby of bot players the same way /start and Join do"""
+    channel = SimpleNamespace(id=guild_id, guild=SimpleNamespace(id=guild_id))
+    start_message = FakeMessage(next(start_message_ids), channel.id, None, {})
+    game = SimulatedGame(channel, start_message, transport, seed)  # pyright: ignore[reportArgumentType]
+    game.start_delay = 0
+    for i in range(players):
+        member = SimpleNamespace(id=start_message.id * 1000 + i + 1, global_name=f"Bot {i + 1}")
+        game.players[member.id] = M.Player(member.id, member.global_name, game.transport)
+    M.add_game(game)
+    return game
+
+
+async def play(
+    transport: T.Transport,
+    players: int,
+    guild_id=1,
+    seed: int | None = None,
+    restart=False,
+    unreachable=0,
+) -> SimulatedGame:
+    """Plays one full game headless and returns it once a team has won
+    Args:
+        restart: stop the game after its first day vote and resume it from its snapshot
+        unreachable: how many of the players' DMs fail, the lobby's DM check
+            should leave them out before roles are handed out"""
+    game = create_game(transport, players, guild_id, seed)
+    game.restart = restart
+    if unreachable:
+        game.fake.unreachable.update(list(game.players)[:unreachable])
+        for player in game.players.values():
+            player.dm_check = asyncio.create_task(game.check_dm(player))
+    try:
+        await game.start(FakeInteraction(game.fake, "start"))  # pyright: ignore[reportArgumentType]
+    except asyncio.CancelledError:
+        task = asyncio.current_task()
+        if not restart or task is None or task.uncancel():
+            raise
+        game = await resume(game, transport)
+    return game
+
+
+async def resume(stopped: SimulatedGame, transport: T.Transport) -> SimulatedGame:
+    """Picks a stopped game up from its snapshot the way the bot does after a restart"""
+    M.store.flush_sync()
+    snapshot, votes = next(
+        (snapshot, votes)
+        for snapshot, votes in M.store.load_snapshots()
+        if snapshot["start_message_id"] == stopped.start_message_id
+    )
+    game = SimulatedGame(stopped.channel, stopped.start_message, transport)
+    game.start_delay = 0
+    game.phase_times = stopped.phase_times
+    game.phase_calls = stopped.phase_calls
+    for player_id, name, *_ in snapshot["players"]:
+        game.players[player_id] = M.Player(player_id, name, game.transport)
+    game.restore(snapshot, votes)
+    M.add_game(game)
+    await game.resume()
+    return game
+
+
+def use_memory_store() -> None:
+    """Points the bot at a throwaway in-memory database, with no event log"""
+    M.store = S.Store(S.SqliteBackend(":memory:"))
+    M.event_log = None
+
+
+async def simulate(
+    games: int,
+    players: int,
+    seed: int | None,
+    latency: float,
+    rate_limit: bool,
+    broadcast: int,
+    events: str | None,
+    restart: bool,
+    unreachable: int,
+) -> None:
+    random.seed(seed)
+    use_memory_store()
+    if events is not None:
+        M.event_log = E.EventLog(events)
+    for guild_id in range(1, 101):
+        config = M.load_config(guild_id)
+        config["Villager"]["broadcast"] = broadcast
+        M.save_config(guild_id, config)
+    fake = FakeTransport(random_voter(random.Random(seed)), latency)
+    transport: T.Transport = T.ScheduledTransport(fake) if rate_limit else fake
+
+    started = time.perf_counter()
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(
+                play(
+                    transport,
+                    players,
+                    guild_id=i % 100 + 1,
+                    seed=None if seed is None else seed + i,
+                    restart=restart,
+                    unreachable=unreachable,
+                )
+            )
+            for i in range(games)
+        ]
+    elapsed = time.perf_counter() - started
+    if M.event_log is not None:
+        M.event_log.close()
+
+    results = [task.result() for task in tasks]
+    phase_times: dict[str, list[float]] = defaultdict(list)
+    for game in results:
+        for phase, times in game.phase_times.items():
+            phase_times[phase].extend(times)
+
+    print(f"{games} games of {players} players in {elapsed:.2f}s")
+    print("Wins:", dict(Counter(game.winning_team for game in results)))
+    print("Calls:", dict(fake.calls))
+    if unreachable:
+        total = games * unreachable
+        played = sum(p.id in fake.unreachable for game in results for p in game.players.values())
+        print(f"Left out: {total - played} of {total} unreachable players")
+    if isinstance(transport, T.ScheduledTransport):
+        print("Superseded edits:", transport.scheduler.superseded)
+    for phase, times in phase_times.items():
+        times.sort()
+        print(
+            f"{phase}: n={len(times)} mean={statistics.fmean(times) * 1000:.2f}ms "
+            f"p99={times[int(len(times) * 0.99)] * 1000:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays werewolf games with bot players")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    parser.add_argument(
+        "--rate-limit", action="store_true", help="send through the rate limit scheduler"
+    )
+    parser.add_argument(
+        "--broadcast", type=int, default=0, help="0 DMs, 1 channel, 2 thread"
+    )
+    parser.add_argument("--events", help="append the games' events to this log for replay.py")
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="stop every game after its first day vote and resume it from its snapshot",
+    )
+    parser.add_argument(
+        "--unreachable",
+        type=int,
+        default=0,
+        help="players per game whose DMs fail with a server error",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        simulate(
+            args.games,
+            args.players,
+            args.seed,
+            args.latency,
+            args.rate_limit,
+            args.broadcast,
+            args.events,
+            args.restart,
+            args.unreachable,
+        )
+    )
@@ -0,0 +1,385 @@
+import asyncio
+import copy
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable
+
+Config = dict[str, dict[str, int]]
+
+GameResult = tuple[int, float, str, list[tuple[int, str, str, bool]]]
+"""(guild id, finished at, winning team, [(player id, role, team, alive)])"""
+
+Snapshot = dict[str, Any]
+
+FLUSH_DELAY = 1.0
+"""Seconds to collect changes before writing them to the backend"""
+
+BUSY_TIMEOUT = 30.0
+"""Seconds a write waits for another process sharing the database to finish its own"""
+
+
+class Batch:
+    """Serialised changes collected between two flushes"""
+
+    def __init__(self) -> None:
+        self.configs: dict[int, str] = {}
+        self.games: list[GameResult] = []
+        self.snapshots: dict[int, str | None] = {}
+        """Game id: snapshot, None deletes the game's snapshot and its votes"""
+        self.votes: dict[tuple[int, str], str | None] = {}
+        """(game id, vote id): snapshot of an open vote, None deletes it"""
+
+
+class Backend(ABC):
+    @abstractmethod
+    def read_config(self, guild_id: int) -> Config | None:
+        """Returns the stored config or None if it is missing or corrupt"""
+
+    @abstractmethod
+    def read_snapshots(self) -> dict[int, tuple[str, list[str]]]:
+        """Returns every saved game snapshot along with its open votes"""
+
+    @abstractmethod
+    def write(self, batch: Batch) -> None:
+        """Writes a batch of changes"""
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteBackend(Backend):
+    """Stores configs and game history in a single SQLite database in WAL mode"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS configs (
+            guild_id INTEGER PRIMARY KEY,
+            config TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS games (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            finished_at REAL NOT NULL,
+            winning_team TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS games_guild ON games (guild_id);
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id INTEGER NOT NULL REFERENCES games (id),
+            player_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            team TEXT NOT NULL,
+            alive INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS game_players_game ON game_players (game_id);
+        CREATE TABLE IF NOT EXISTS snapshots (
+            game_id INTEGER PRIMARY KEY,
+            snapshot TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS vote_snapshots (
+            game_id INTEGER NOT NULL,
+            vote_id TEXT NOT NULL,
+            snapshot TEXT NOT NULL,
+            PRIMARY KEY (game_id, vote_id)
+        );
+    """
+
+    def __init__(self, path: str = "werewolf.db") -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._reader: sqlite3.Connection | None = None
+        self.read_lock = self.lock if path == ":memory:" else threading.Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # Opened on first use so importing the bot doesn't create the database
+        if self._db is None:
+            # Batched writes happen in a worker thread. WAL lets every worker
+            # of a cluster read while one of them writes
+            self._db = sqlite3.connect(
+                self.path, timeout=BUSY_TIMEOUT, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        """Connection for reads on the event loop. It doesn't share the writer's
+        lock, and in WAL mode reads don't wait for another process's write, so
+        a config read never blocks the loop for a transaction"""
+        if self.path == ":memory:":
+            # The one connection is the whole database
+            return self.db
+        if self._reader is None:
+            self.db  # Creates the database and its tables
+            self._reader = sqlite3.connect(self.path, check_same_thread=False)
+        return self._reader
+
+    def read_config(self, guild_id: int) -> Config | None:
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT config FROM configs WHERE guild_id = ?", (guild_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except json.JSONDecodeError:
+            return None
+
+    def read_snapshots(self) -> dict[int, tuple[str, list[str]]]:
+        with self.lock:
+            snapshots: dict[int, tuple[str, list[str]]] = {
+                game_id: (snapshot, [])
+                for game_id, snapshot in self.db.execute(
+                    "SELECT game_id, snapshot FROM snapshots"
+                )
+            }
+            for game_id, snapshot in self.db.execute(
+                "SELECT game_id, snapshot FROM vote_snapshots"
+            ):
+                if game_id in snapshots:
+                    snapshots[game_id][1].append(snapshot)
+        return snapshots
+
+    def write(self, batch: Batch) -> None:
+        saved = [(k, v) for k, v in batch.snapshots.items() if v is not None]
+        deleted = [(k,) for k, v in batch.snapshots.items() if v is None]
+        saved_votes = [(*k, v) for k, v in batch.votes.items() if v is not None]
+        deleted_votes = [k for k, v in batch.votes.items() if v is None]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO configs (guild_id, config) VALUES (?, ?) "
+                "ON CONFLICT (guild_id) DO UPDATE SET config = excluded.config",
+                batch.configs.items(),
+            )
+            self.db.executemany(
+                "INSERT INTO snapshots (game_id, snapshot) VALUES (?, ?) "
+                "ON CONFLICT (game_id) DO UPDATE SET snapshot = excluded.snapshot",
+                saved,
+            )
+            self.db.executemany("DELETE FROM snapshots WHERE game_id = ?", deleted)
+            self.db.executemany("DELETE FROM vote_snapshots WHERE game_id = ?", deleted)
+            self.db.executemany(
+                "INSERT INTO vote_snapshots (game_id, vote_id, snapshot) VALUES (?, ?, ?) "
+                "ON CONFLICT (game_id, vote_id) DO UPDATE SET snapshot = excluded.snapshot",
+                saved_votes,
+            )
+            self.db.executemany(
+                "DELETE FROM vote_snapshots WHERE game_id = ? AND vote_id = ?",
+                deleted_votes,
+            )
+            for guild_id, finished_at, winning_team, players in batch.games:
+                game_id = self.db.execute(
+                    "INSERT INTO games (guild_id, finished_at, winning_team) "
+                    "VALUES (?, ?, ?)",
+                    (guild_id, finished_at, winning_team),
+                ).lastrowid
+                self.db.executemany(
+                    "INSERT INTO game_players (game_id, player_id, role, team, alive) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(game_id, *player) for player in players],
+                )
+
+    def close(self) -> None:
+        with self.lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class Store:
+    """Keeps every guild's config in memory and writes changes behind.
+
+    Reads only touch the backend the first time a guild is seen. Saves,
+    finished games and game snapshots are queued and written off the event
+    loop in one batch per FLUSH_DELAY. Snapshots are taken when the batch is
+    written, so a game that changes many times in between is written once."""
+
+    def __init__(
+        self,
+        backend: Backend,
+        defaults: Callable[[], Config] | None = None,
+        flush_delay=FLUSH_DELAY,
+    ) -> None:
+        self.backend = backend
+        self.defaults = defaults
+        self.flush_delay = flush_delay
+        self.cache: dict[int, Config] = {}
+        self.dirty: set[int] = set()
+        self.games: list[GameResult] = []
+        self.snapshots: dict[int, Callable[[], Snapshot] | None] = {}
+        self.votes: dict[tuple[int, str], Callable[[], Snapshot] | None] = {}
+        self.failed: Batch | None = None
+        """A batch the backend failed to write, retried with the next one"""
+        self.flusher: asyncio.Task | None = None
+
+    def load(self, guild_id: int) -> Config | None:
+        """Returns a copy of the cached config. Callers get their own copy, so
+        a game's config can't change under it until it is saved and loaded again
+        Returns:
+            dict: the config, or None if it is missing or corrupt"""
+        config = self.peek(guild_id)
+        return None if config is None else copy.deepcopy(config)
+
+    def peek(self, guild_id: int) -> Config | None:
+        """Returns the cached config itself, reading it from the backend on
+        first use. It is shared, callers that change it have to load a copy
+        Returns:
+            dict: the config, or None if it is missing or corrupt"""
+        if guild_id in self.cache:
+            return self.cache[guild_id]
+        config = self.backend.read_config(guild_id)
+        if config is not None:
+            if self.defaults is not None:
+                # Configs saved before a role or option existed get its default
+                for role, options in self.defaults().items():
+                    for option, value in options.items():
+                        config.setdefault(role, {}).setdefault(option, value)
+            self.cache[guild_id] = config
+        return config
+
+    def save(self, guild_id: int, config: Config) -> None:
+        self.cache[guild_id] = copy.deepcopy(config)
+        self.dirty.add(guild_id)
+        self.schedule_flush()
+
+    def record_game(
+        self,
+        guild_id: int,
+        winning_team: str,
+        players: list[tuple[int, str, str, bool]],
+    ) -> None:
+        """Queues the result of a finished game for the history"""
+        self.games.append((guild_id, time.time(), winning_team, players))
+        self.schedule_flush()
+
+    def save_snapshot(self, game_id: int, snapshot: Callable[[], Snapshot]) -> None:
+        """Queues a game's state to be saved, snapshot is called when it is written"""
+        self.snapshots[game_id] = snapshot
+        self.schedule_flush()
+
+    def save_vote(
+        self, game_id: int, vote_id: str, snapshot: Callable[[], Snapshot]
+    ) -> None:
+        """Queues an open vote's state to be saved alongside its game"""
+        self.votes[(game_id, vote_id)] = snapshot
+        self.schedule_flush()
+
+    def delete_vote(self, game_id: int, vote_id: str) -> None:
+        self.votes[(game_id, vote_id)] = None
+        self.schedule_flush()
+
+    def delete_snapshot(self, game_id: int) -> None:
+        """Forgets a finished game and all of its votes"""
+        self.snapshots[game_id] = None
+        self.votes = {key: vote for key, vote in self.votes.items() if key[0] != game_id}
+        self.schedule_flush()
+
+    def load_snapshots(self) -> list[tuple[Snapshot, list[Snapshot]]]:
+        """Returns every saved game with its open votes, for resuming after a restart"""
+        return [
+            (json.loads(snapshot), [json.loads(vote) for vote in votes])
+            for snapshot, votes in self.backend.read_snapshots().values()
+        ]
+
+    def schedule_flush(self) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to write behind on, e.g. in scripts
+            self.flush_sync()
+            return
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+
+    def pending(self) -> bool:
+        return bool(
+            self.failed or self.dirty or self.games or self.snapshots or self.votes
+        )
+
+    def take_pending(self) -> Batch:
+        """Serialises and clears the pending changes, on top of a failed batch"""
+        batch, self.failed = self.failed or Batch(), None
+        batch.configs.update(
+            (guild_id, json.dumps(self.cache[guild_id], indent=4)) for guild_id in self.dirty
+        )
+        batch.games += self.games
+        batch.snapshots.update(
+            (game_id, None if snapshot is None else json.dumps(snapshot()))
+            for game_id, snapshot in self.snapshots.items()
+        )
+        batch.votes.update(
+            (key, None if snapshot is None else json.dumps(snapshot()))
+            for key, snapshot in self.votes.items()
+        )
+        # A failed batch can hold votes of a game that has since finished
+        batch.votes = {
+            key: vote
+            for key, vote in batch.votes.items()
+            if key[0] not in batch.snapshots or batch.snapshots[key[0]] is not None
+        }
+        self.dirty = set()
+        self.games = []
+        self.snapshots = {}
+        self.votes = {}
+        return batch
+
+    async def flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        while self.pending():
+            batch = self.take_pending()
+            try:
+                await asyncio.to_thread(self.backend.write, batch)
+            except (sqlite3.Error, OSError) as e:
+                # e.g. the database stayed locked past BUSY_TIMEOUT or the disk is full
+                print(f"Failed to write to storage, retrying: {e}", file=sys.stderr)
+                self.failed = batch
+                await asyncio.sleep(self.flush_delay)
+
+    def flush_sync(self) -> None:
+        if self.pending():
+            self.backend.write(self.take_pending())
+
+    def close(self) -> None:
+        self.flush_sync()
+        self.backend.close()
+
+
+def migrate_json(directory: str, backend: Backend) -> int:
+    """Copies every {guild_id}.json config in a directory into a backend
+    Returns:
+        int: the number of configs migrated"""
+    configs = {}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        name = os.path.basename(path)[: -len(".json")]
+        if not name.isdigit():
+            continue
+        try:
+            with open(path, "r") as f:
+                configs[int(name)] = json.dumps(json.load(f), indent=4)
+        except json.JSONDecodeError:
+            print(f"Skipping corrupt config {path}")
+    batch = Batch()
+    batch.configs = configs
+    backend.write(batch)
+    return len(configs)
+
+
+if __name__ == "__main__":
+    # python storage.py [json directory] [database]
+    directory = sys.argv[1] if len(sys.argv) > 1 else "."
+    database = sys.argv[2] if len(sys.argv) > 2 else "werewolf.db"
+    backend = SqliteBackend(database)
+    print(f"Migrated {migrate_json(directory, backend)} configs into {database}")
+    backend.close()
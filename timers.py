@@ -0,0 +1,122 @@
+import asyncio
+import math
+from typing import Awaitable, Callable
+
+TICK = 1.0
+"""Seconds per slot of the timer wheel"""
+
+SLOTS = 512
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled", "wheel")
+
+    def __init__(self, deadline: int, callback: Callable[[], object], wheel: "TimerWheel") -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+        self.wheel = wheel
+
+    def cancel(self) -> None:
+        if not self.cancelled:
+            self.cancelled = True
+            self.wheel.pending -= 1
+
+
+class TimerWheel:
+    """Fires callbacks after a delay, to the nearest tick.
+
+    Every pending deadline is one entry in a slot of the wheel and a single
+    task walks the slots once per tick, so thousands of open votes don't each
+    need a sleeping task. The task stops while nothing is pending."""
+
+    def __init__(self, tick=TICK, slots=SLOTS) -> None:
+        self.tick = tick
+        self.wheel: list[list[Timer]] = [[] for _ in range(slots)]
+        self.pending = 0
+        self.processed: int | None = None
+        """Last tick whose slot has been fired"""
+        self.task: asyncio.Task | None = None
+
+    def now(self) -> int:
+        return math.floor(asyncio.get_running_loop().time() / self.tick)
+
+    def schedule(self, delay: float, callback: Callable[[], object]) -> Timer:
+        if self.task is None or self.task.done():
+            self.processed = self.now()
+            self.task = asyncio.create_task(self.run())
+        assert self.processed is not None
+
+        now = asyncio.get_running_loop().time()
+        deadline = max(math.ceil((now + delay) / self.tick), self.processed + 1)
+        timer = Timer(deadline, callback, self)
+        self.wheel[deadline % len(self.wheel)].append(timer)
+        self.pending += 1
+        return timer
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            assert self.processed is not None
+            await asyncio.sleep((self.processed + 1) * self.tick - loop.time())
+            # Catch up on every tick missed if the loop was blocked
+            for tick in range(self.processed + 1, self.now() + 1):
+                self.fire(tick)
+                self.processed = tick
+
+    def fire(self, tick: int) -> None:
+        index = tick % len(self.wheel)
+        slot = self.wheel[index]
+        self.wheel[index] = []
+        for timer in slot:
+            if timer.cancelled:
+                continue
+            if timer.deadline > tick:
+                # Due on a later lap of the wheel
+                self.wheel[index].append(timer)
+                continue
+            timer.cancel()
+            timer.callback()
+
+
+timer_wheel = TimerWheel()
+
+
+class Coalescer:
+    """Runs an update at most once per interval however often it is requested,
+    a burst of requests is caught up on by one run once the interval is up.
+
+    update returns whether it did anything, an update with nothing new to
+    show doesn't hold back the next one."""
+
+    def __init__(self, update: Callable[[], Awaitable[bool]], interval: float) -> None:
+        self.update = update
+        self.interval = interval
+        self.last = 0.0
+        self.dirty = False
+        self.task: asyncio.Task | None = None
+
+    def request(self) -> None:
+        self.dirty = True
+        if not self.running():
+            self.task = asyncio.create_task(self.flush())
+
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.dirty:
+            delay = self.last + self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.dirty = False
+            started = loop.time()
+            if await self.update():
+                self.last = started
+
+    def cancel(self) -> None:
+        """Drops the pending update"""
+        if self.task is not None:
+            self.task.cancel()
+        self.dirty = False
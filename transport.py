@@ -0,0 +1,230 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any, Awaitable, Hashable
+
+import disnake
+
+import metrics
+import scheduler as Sch
+
+if TYPE_CHECKING:
+    from main import Player
+
+
+class Priority(IntEnum):
+    """Order outbound requests are sent in when they have to queue"""
+
+    VOTE = 0
+    NOTICE = 1
+    COSMETIC = 2
+
+
+class Transport(ABC):
+    """Everything the game sends to Discord goes through a transport, so the
+    game loop can run against a fake one without a gateway connection.
+
+    fields are passed on as keyword arguments (embed, components, ...), only
+    the ones given are touched when editing."""
+
+    @abstractmethod
+    async def send(
+        self,
+        player: "Player",
+        content: str | None = None,
+        priority=Priority.NOTICE,
+        **fields,
+    ) -> Any:
+        """DMs a player and returns the sent message"""
+
+    @abstractmethod
+    async def post(
+        self, channel: Any, content: str | None = None, priority=Priority.NOTICE, **fields
+    ) -> Any:
+        """Posts a message in a channel or thread and returns it"""
+
+    @abstractmethod
+    async def create_thread(self, channel: Any, name: str) -> Any:
+        """Opens a public thread in a channel to post a game's messages in"""
+
+    @abstractmethod
+    async def edit(self, message: Any, priority=Priority.COSMETIC, **fields) -> None:
+        """Edits a message previously returned by send or post"""
+
+    def channel(self, message: Any) -> Hashable:
+        """Returns the id of the channel a sent message is in"""
+        return message.channel.id
+
+    @abstractmethod
+    def messageable(self, channel_id: Any) -> Any:
+        """Returns a channel to post in from its id, without fetching it"""
+
+    @abstractmethod
+    def message(self, channel_id: Any, message_id: int) -> Any:
+        """Returns a message sent before a restart that can be edited again"""
+
+    def metered(self, guild_id: int, calls: Counter[str]) -> "Transport":
+        """Returns this transport counting the requests it sends for a game"""
+        return MeteredTransport(self, guild_id, calls)
+
+
+DM_CHANNELS = 100_000
+"""DM channel ids remembered, the oldest are forgotten past this"""
+
+
+class DiscordTransport(Transport):
+    def __init__(self, client: disnake.Client) -> None:
+        self.client = client
+        self.dm_channels: dict[int, int] = {}
+        """User id: their DM channel id, so a DM after the first needs no lookups"""
+
+    async def dm_channel(self, user_id: int) -> Any:
+        channel_id = self.dm_channels.get(user_id)
+        if channel_id is None:
+            user = self.client.get_user(user_id) or await self.client.fetch_user(user_id)
+            channel_id = (user.dm_channel or await user.create_dm()).id
+            if len(self.dm_channels) >= DM_CHANNELS:
+                del self.dm_channels[next(iter(self.dm_channels))]
+            self.dm_channels[user_id] = channel_id
+        return self.client.get_partial_messageable(channel_id, type=disnake.ChannelType.private)
+
+    async def send(
+        self,
+        player: "Player",
+        content: str | None = None,
+        priority=Priority.NOTICE,
+        **fields,
+    ) -> Any:
+        channel = await self.dm_channel(player.id)
+        return await channel.send(content, **fields)
+
+    async def post(
+        self, channel: Any, content: str | None = None, priority=Priority.NOTICE, **fields
+    ) -> Any:
+        return await channel.send(content, **fields)
+
+    async def create_thread(self, channel: Any, name: str) -> Any:
+        return await channel.create_thread(
+            name=name, type=disnake.ChannelType.public_thread
+        )
+
+    async def edit(self, message: Any, priority=Priority.COSMETIC, **fields) -> None:
+        await message.edit(**fields)
+
+    def messageable(self, channel_id: Any) -> Any:
+        return self.client.get_partial_messageable(channel_id)
+
+    def message(self, channel_id: Any, message_id: int) -> Any:
+        return self.messageable(channel_id).get_partial_message(message_id)
+
+
+class ScheduledTransport(Transport):
+    """Sends through another transport, queued by a rate limit aware scheduler"""
+
+    def __init__(self, inner: Transport, scheduler: Sch.Scheduler | None = None) -> None:
+        self.inner = inner
+        self.scheduler = scheduler or Sch.Scheduler()
+
+    async def send(
+        self,
+        player: "Player",
+        content: str | None = None,
+        priority=Priority.NOTICE,
+        **fields,
+    ) -> Any:
+        return await self.scheduler.submit(
+            ("dm", player.id), priority, self.inner.send, player=player, content=content, **fields
+        )
+
+    async def post(
+        self, channel: Any, content: str | None = None, priority=Priority.NOTICE, **fields
+    ) -> Any:
+        return await self.scheduler.submit(
+            ("channel", channel.id),
+            priority,
+            self.inner.post,
+            channel=channel,
+            content=content,
+            **fields,
+        )
+
+    async def create_thread(self, channel: Any, name: str) -> Any:
+        return await self.scheduler.submit(
+            ("channel", channel.id),
+            Priority.VOTE,
+            self.inner.create_thread,
+            channel=channel,
+            name=name,
+        )
+
+    async def edit(self, message: Any, priority=Priority.COSMETIC, **fields) -> None:
+        await self.scheduler.submit(
+            ("channel", self.inner.channel(message)),
+            priority,
+            self.inner.edit,
+            edit_key=id(message),
+            message=message,
+            **fields,
+        )
+
+    def channel(self, message: Any) -> Hashable:
+        return self.inner.channel(message)
+
+    def messageable(self, channel_id: Any) -> Any:
+        return self.inner.messageable(channel_id)
+
+    def message(self, channel_id: Any, message_id: int) -> Any:
+        return self.inner.message(channel_id, message_id)
+
+    def metered(self, guild_id: int, calls: Counter[str]) -> Transport:
+        # Counted under the scheduler, so merged edits aren't counted as requests
+        return ScheduledTransport(self.inner.metered(guild_id, calls), self.scheduler)
+
+
+class MeteredTransport(Transport):
+    """Counts the requests a game makes through another transport, and the
+    ones that failed, for the game and for its guild"""
+
+    def __init__(self, inner: Transport, guild_id: int, calls: Counter[str]) -> None:
+        self.inner = inner
+        self.guild_id = guild_id
+        self.calls = calls
+
+    async def call(self, kind: str, request: Awaitable[Any]) -> Any:
+        self.calls[kind] += 1
+        metrics.registry.count("api_calls", guild=self.guild_id, kind=kind)
+        try:
+            return await request
+        except Exception:
+            self.calls["errors"] += 1
+            metrics.registry.count("api_errors", guild=self.guild_id, kind=kind)
+            raise
+
+    async def send(
+        self,
+        player: "Player",
+        content: str | None = None,
+        priority=Priority.NOTICE,
+        **fields,
+    ) -> Any:
+        return await self.call("send", self.inner.send(player, content, priority, **fields))
+
+    async def post(
+        self, channel: Any, content: str | None = None, priority=Priority.NOTICE, **fields
+    ) -> Any:
+        return await self.call("post", self.inner.post(channel, content, priority, **fields))
+
+    async def create_thread(self, channel: Any, name: str) -> Any:
+        return await self.call("create_thread", self.inner.create_thread(channel, name))
+
+    async def edit(self, message: Any, priority=Priority.COSMETIC, **fields) -> None:
+        await self.call("edit", self.inner.edit(message, priority, **fields))
+
+    def channel(self, message: Any) -> Hashable:
+        return self.inner.channel(message)
+
+    def messageable(self, channel_id: Any) -> Any:
+        return self.inner.messageable(channel_id)
+
+    def message(self, channel_id: Any, message_id: int) -> Any:
+        return self.inner.message(channel_id, message_id)
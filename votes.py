@@ -0,0 +1,422 @@
+import asyncio
+import time
+from collections import Counter
+from typing import TYPE_CHECKING
+
+import disnake
+
+import timers
+import transport as T
+
+if TYPE_CHECKING:
+    from main import Player, Game
+
+
+VoteKey = tuple[int, str, int]
+"""(start message id, vote id, voter id)"""
+
+OPEN_CONCURRENCY = 10
+"""Max vote DMs in flight at once while opening a vote"""
+
+UPDATE_INTERVAL = 1.0
+"""Minimum seconds between two edits of a vote's tally embed"""
+
+SHARED_VOTER = 0
+"""Voter id in the custom_id of a vote posted once for everyone"""
+
+MAX_OPTIONS = 25
+MAX_SELECTS = 4
+"""Discord allows 25 options per select and 5 rows per message, one is the confirm button"""
+
+MAX_FIELDS = 25
+"""Fields Discord allows in an embed"""
+
+MAX_CONTENT = 2000
+"""Characters Discord allows in a message's content"""
+
+
+def add_fields(embed: disnake.Embed, fields: list[tuple[str, str]]) -> None:
+    """Adds a field per name and value, or several per field past MAX_FIELDS of them"""
+    if len(fields) <= MAX_FIELDS:
+        for name, value in fields:
+            embed.add_field(name=name, value=value, inline=True)
+        return
+    lines = [f"{name}: {value}" for name, value in fields]
+    per_field = -(-len(lines) // MAX_FIELDS)
+    for start in range(0, len(lines), per_field):
+        embed.add_field(
+            name="\u200b", value="\n".join(lines[start : start + per_field]), inline=True
+        )
+
+
+class VoteSession:
+    def __init__(
+        self,
+        game: "Game",
+        title: str,
+        colour: disnake.Colour,
+        vote_id: str,
+        voters: list["Player"],
+        options: list["Player"],
+        update=True,
+        skippable=False,
+        update_interval=UPDATE_INTERVAL,
+        timeout: float | None = None,
+        channel=None,
+    ) -> None:
+        """channel: post the vote there once for every voter instead of DMing it"""
+        self.game = game
+        self.title = title
+        self.colour = colour
+        self.vote_id = vote_id
+        self.voters = voters
+        self.update = update
+        self.timeout = timeout
+        self.channel = channel
+        self.timed_out = False
+        self.deadline: timers.Timer | None = None
+        self.ends_at: float | None = None
+        """Wall clock time the deadline falls on, kept across restarts"""
+        self.restored = False
+
+        self.targets: dict[str, str] = {p.name: str(p.id) for p in options}
+        if skippable:
+            self.targets["Skip"] = "0"
+
+        self.embed_ids: list[disnake.Message] = []
+        self.votes: dict[int, int | None] = {p.id: None for p in voters}
+        """voter_id -> target_id"""
+        self.confirmed: set[int] = set()
+        self.vote_event = asyncio.Event()
+
+        self.rendered: tuple[str, ...] = ()
+        self.updates = timers.Coalescer(self.update_message, update_interval)
+
+    def keys(self) -> list[VoteKey]:
+        if self.channel is not None:
+            return [(self.game.start_message_id, self.vote_id, SHARED_VOTER)]
+        return [
+            (self.game.start_message_id, self.vote_id, voter.id)
+            for voter in self.voters
+        ]
+
+    def custom_id(self, kind: str, voter: "Player | None", page=0) -> str:
+        """page: which of the vote's selects, the first has no number"""
+        voter_id = SHARED_VOTER if voter is None else voter.id
+        kind = f"{kind}{page or ''}"
+        return f"{kind} {self.vote_id} {self.game.start_message_id} {voter_id} {self.game.id}"
+
+    async def run(self) -> "Player | None":
+        vote_router.register(self)
+        self.game.sessions.add(self)
+        try:
+            if self.restored:
+                self.request_update()
+                if len(self.confirmed) == len(self.voters):
+                    self.vote_event.set()
+            else:
+                await self.open()
+            if self.timeout is not None:
+                self.deadline = timers.timer_wheel.schedule(self.timeout, self.expire)
+                if self.ends_at is None:
+                    self.ends_at = time.time() + self.timeout
+            self.game.save_vote(self)
+            await self.vote_event.wait()
+            # Left in place when cancelled so the vote can be picked up after a restart
+            self.game.forget_vote(self)
+        finally:
+            self.cancel()
+        await self.close()
+        return self.result()
+
+    def snapshot(self) -> dict:
+        """Serialisable state of the open vote"""
+        return {
+            "vote_id": self.vote_id,
+            "votes": list(self.votes.items()),
+            "confirmed": sorted(self.confirmed),
+            "messages": [
+                [self.game.transport.channel(message), message.id]
+                for message in self.embed_ids
+            ],
+            "ends_at": self.ends_at,
+        }
+
+    def restore(self, snapshot: dict) -> None:
+        """Re-attaches to the messages of a vote saved before a restart
+        instead of sending new ones when it runs"""
+        for voter_id, target_id in snapshot["votes"]:
+            if voter_id in self.votes:
+                self.votes[voter_id] = target_id
+        self.confirmed = {voter_id for voter_id in snapshot["confirmed"] if voter_id in self.votes}
+        self.embed_ids = [
+            self.game.transport.message(channel_id, message_id)
+            for channel_id, message_id in snapshot["messages"]
+        ]
+        self.ends_at = snapshot["ends_at"]
+        if self.ends_at is not None:
+            self.timeout = max(0.0, self.ends_at - time.time())
+        self.restored = True
+
+    async def open(self) -> None:
+        if self.update:
+            self.rendered = self.render()
+            embed = self.tally_embed(self.rendered)
+        else:
+            embed = disnake.Embed(title=self.title, colour=self.colour)
+
+        if self.channel is not None:
+            self.embed_ids.append(
+                await self.game.transport.post(
+                    self.channel,
+                    embed=embed,
+                    components=self.components(None),
+                    priority=T.Priority.VOTE,
+                )
+            )
+            return
+
+        semaphore = asyncio.Semaphore(OPEN_CONCURRENCY)
+
+        async def send(voter: "Player") -> None:
+            async with semaphore:
+                self.embed_ids.append(
+                    await voter.send(
+                        embed=embed,
+                        components=self.components(voter),
+                        priority=T.Priority.VOTE,
+                    )
+                )
+
+        async with asyncio.TaskGroup() as tg:
+            for voter in self.voters:
+                tg.create_task(send(voter))
+
+    def components(self, voter: "Player | None") -> list[disnake.ui.Item]:
+        """A select per MAX_OPTIONS targets and the confirm button"""
+        targets = list(self.targets.items())
+        pages = range(0, len(targets), MAX_OPTIONS)
+        return [
+            *(
+                disnake.ui.StringSelect(
+                    options=dict(targets[start : start + MAX_OPTIONS]),
+                    custom_id=self.custom_id("Select", voter, page),
+                    placeholder=f"Choose ({page + 1}/{len(pages)})" if len(pages) > 1 else None,
+                )
+                for page, start in enumerate(pages)
+            ),
+            disnake.ui.Button(
+                label="Confirm",
+                style=disnake.ButtonStyle.success,
+                custom_id=self.custom_id("Confirm", voter),
+            ),
+        ]
+
+    def cancel(self) -> None:
+        """Stops routing interactions and timers to this vote"""
+        if self.deadline is not None:
+            self.deadline.cancel()
+        self.updates.cancel()
+        vote_router.unregister(self)
+        self.game.sessions.discard(self)
+
+    def expire(self) -> None:
+        """Closes the vote with whatever has been confirmed so far"""
+        self.timed_out = True
+        self.vote_event.set()
+
+    def render(self) -> tuple[str, ...]:
+        """Returns the tally field values in voter order"""
+        values = []
+        value: str
+        for player in self.voters:
+            if self.votes[player.id] is None:
+                value = "No Vote"
+            elif self.votes[player.id] == 0:
+                value = "Skip"
+            else:
+                value = self.game.players[self.votes[player.id]].name
+
+            if player.id in self.confirmed:
+                value = value + " ✅"
+            values.append(value)
+        return tuple(values)
+
+    def tally_embed(self, values: tuple[str, ...]) -> disnake.Embed:
+        embed = disnake.Embed(title=self.title, colour=self.colour)
+        add_fields(embed, [(voter.name, value) for voter, value in zip(self.voters, values)])
+        return embed
+
+    def request_update(self) -> None:
+        """Schedules a tally edit, coalescing bursts into one edit per interval"""
+        if self.update:
+            self.updates.request()
+
+    async def update_message(self) -> bool:
+        """Edits the tally into every vote message
+        Returns:
+            bool: whether it had changed since the last edit"""
+        values = self.render()
+        if values == self.rendered:
+            return False
+
+        embed = self.tally_embed(values)
+        async with asyncio.TaskGroup() as tg:
+            for embed_id in self.embed_ids:
+                tg.create_task(self.edit_tally(embed_id, embed))
+        self.rendered = values
+        return True
+
+    async def edit_tally(self, message, embed: disnake.Embed) -> None:
+        """Edits one vote message. The tally is cosmetic, so a message that was
+        deleted or can't be edited only leaves that message behind"""
+        try:
+            await self.game.transport.edit(message, embed=embed)
+        except disnake.HTTPException:
+            pass
+
+    async def close(self) -> None:
+        """Stops pending tally edits and flushes the final state"""
+        self.updates.cancel()
+        if self.update:
+            await self.update_message()
+
+    async def voter_id(self, inter: disnake.MessageInteraction, voter_id: int) -> int | None:
+        """Works out who clicked, which on a shared vote is whoever pressed it"""
+        if voter_id != SHARED_VOTER:
+            return voter_id
+        if inter.author.id in self.votes:
+            return inter.author.id
+        await inter.send("You can't vote in this", ephemeral=True)
+        return None
+
+    async def handle_dropdown(
+        self, inter: disnake.MessageInteraction, voter_id: int
+    ) -> None:
+        await inter.response.defer(with_message=False)
+        self.game.touch()
+        clicked = await self.voter_id(inter, voter_id)
+        if clicked is None:
+            return
+        if not inter.data.values:
+            return
+        self.votes[clicked] = int(inter.data.values[0])
+        self.game.log("select", vote=self.vote_id, voter=clicked, target=self.votes[clicked])
+        self.request_update()
+        self.game.save_vote(self)
+
+    async def handle_confirm(
+        self, inter: disnake.MessageInteraction, voter_id: int
+    ) -> None:
+        self.game.touch()
+        clicked = await self.voter_id(inter, voter_id)
+        if clicked is None:
+            return
+        if clicked in self.confirmed:
+            # A double click, already counted and answered
+            await inter.response.defer(with_message=False)
+            return
+        choice = self.votes[clicked]
+        if choice is None:
+            await inter.send("Please select an option", ephemeral=True)
+            return
+
+        # Counted before replying, so a second click while the reply is in
+        # flight can't count it again
+        self.confirmed.add(clicked)
+        self.game.log("confirm", vote=self.vote_id, voter=clicked, target=choice)
+        self.request_update()
+        self.game.save_vote(self)
+        # when all voters have picked, trigger event
+        if len(self.confirmed) == len(self.voters):
+            self.vote_event.set()
+
+        # Keep the channel readable, only the voter needs to see their choice
+        ephemeral = self.channel is not None
+        if choice == 0:
+            await inter.send("Skipped vote", ephemeral=ephemeral)
+        else:
+            await inter.send(f"Selected {self.game.players[choice].name}", ephemeral=ephemeral)
+
+    def result(self) -> "Player | None":
+        """Returns the player with the most confirmed votes or None if tied"""
+        if not self.confirmed:
+            return None
+        tally = Counter(self.votes[voter_id] for voter_id in self.confirmed)
+        max_votes = max(tally.values())
+        winners = [target for target, count in tally.items() if count == max_votes]
+
+        if len(winners) > 1:
+            return None
+
+        if not winners[0]:
+            return None
+        return self.game.players[winners[0]]
+
+
+class VoteRouter:
+    """Routes vote dropdowns and confirm buttons to their open vote session.
+
+    Every vote component carries a custom_id of the form
+    "{Select|Confirm} {vote_id} {start_message_id} {voter_id} {guild_id}", with
+    the page number after Select on a vote's second select onwards, which
+    is parsed once per interaction and looked up directly instead of being
+    offered to every open vote. Votes sent before the guild id was added end
+    at the voter id."""
+
+    def __init__(self) -> None:
+        self.sessions: dict[VoteKey, VoteSession] = {}
+
+    def register(self, session: VoteSession) -> None:
+        for key in session.keys():
+            self.sessions[key] = session
+
+    def unregister(self, session: VoteSession) -> None:
+        for key in session.keys():
+            if self.sessions.get(key) is session:
+                del self.sessions[key]
+
+    @staticmethod
+    def parse(custom_id: str) -> tuple[str, VoteKey] | None:
+        """Splits a vote custom_id into its kind and session key
+        Returns:
+            tuple: ("Select" or "Confirm", key) or None if it is not a vote component"""
+        parts = custom_id.split(" ")
+        if len(parts) not in (4, 5):
+            return None
+        kind, vote_id, game_id, voter_id = parts[:4]
+        if kind.rstrip("0123456789") == "Select":
+            kind = "Select"
+        if kind not in ("Select", "Confirm"):
+            return None
+        try:
+            return kind, (int(game_id), vote_id, int(voter_id))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def guild(custom_id: str) -> int | None:
+        """The guild a vote component's game is in, None if its custom_id predates it"""
+        parts = custom_id.split(" ")
+        if len(parts) != 5 or not parts[4].isdigit():
+            return None
+        return int(parts[4])
+
+    async def dispatch(self, inter: disnake.MessageInteraction) -> bool:
+        """Returns whether a vote open here took the interaction"""
+        parsed = self.parse(inter.data.custom_id)
+        if parsed is None:
+            return False
+        kind, key = parsed
+        session = self.sessions.get(key)
+        if session is None:
+            return False
+
+        if kind == "Select":
+            await session.handle_dropdown(inter, key[2])
+        else:
+            await session.handle_confirm(inter, key[2])
+        return True
+
+
+vote_router = VoteRouter()